@@ -1,2 +1,3 @@
 from .application import BiliChat
+from .host import BiliChatHost
 from .event.models import *
\ No newline at end of file
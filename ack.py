@@ -0,0 +1,80 @@
+import asyncio
+import typing as T
+
+import aiohttp
+
+from .logger import Network
+
+class AckWriter:
+    def __init__(self,
+                 post: T.Callable[[int, int, int], T.Awaitable] = None,
+                 delay: float = 1.0,
+                 concurrency: int = 4):
+        self.post = post # (talker_id, session_type, ack_seqno) -> update_ack 请求
+        self.delay = delay # 首个待写入的已读回执最多等待多久被发出
+        self.concurrency = concurrency
+        self.requested = 0
+        self.sent = 0
+        self.failed = 0
+
+        self._pending: T.Dict[int, T.Tuple[int, int]] = {} # talker_id -> (session_type, ack_seqno)
+        self._timer: T.Optional[asyncio.TimerHandle] = None
+        self._flushing: T.Set[asyncio.Task] = set()
+
+    def ack(self, talker_id: int, session_type: int, ack_seqno: int):
+        # 只保留每个会话最新的 seqno，同一窗口内的多次已读合并为一次请求
+        self.requested += 1
+        current = self._pending.get(talker_id)
+        if current is None or current[1] < ack_seqno:
+            self._pending[talker_id] = (session_type, ack_seqno)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._schedule_flush)
+
+    def _schedule_flush(self):
+        self._timer = None
+        task = asyncio.get_running_loop().create_task(self.flush())
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async def send(talker_id, session_type, ack_seqno):
+            async with semaphore:
+                try:
+                    await self.post(talker_id, session_type, ack_seqno)
+                    self.sent += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.failed += 1
+                    Network.error(f"acking session {talker_id} failed: {e.__class__.__name__}")
+                    current = self._pending.get(talker_id)
+                    if current is None or current[1] < ack_seqno: # 没有更新的回执时留待下次重试
+                        self.ack(talker_id, session_type, ack_seqno)
+        await asyncio.gather(*[
+            send(talker_id, session_type, ack_seqno)
+            for talker_id, (session_type, ack_seqno) in pending.items()
+        ])
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
+        await self.flush()
+
+    @property
+    def saved(self) -> int:
+        # 被合并而无需单独发送的已读请求数
+        return self.requested - self.sent - self.failed - len(self._pending)
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "pending": len(self._pending),
+            "requested": self.requested,
+            "sent": self.sent,
+            "failed": self.failed,
+            "saved": self.saved
+        }
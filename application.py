@@ -2,134 +2,457 @@ import aiohttp
 import asyncio
 import inspect
 import copy
+import functools
+import json
 import time
+import traceback
 
 from contextlib import AsyncExitStack
+from pathlib import Path
 from typing import Callable, NamedTuple, Awaitable, Any, List, Dict
-from async_lru import alru_cache
 
 from .event import InternalEvent
-from .event.builtins import ExecutorProtocol, Depend
+from .event.builtins import (
+    ExecutorProtocol, Depend, CallPlan,
+    PARAM_ANNOTATION, PARAM_DEPEND, PARAM_EXTRA,
+    SCOPE_EVENT, SCOPE_SESSION
+)
 from .event.models import (
-    Message, MessageRecall, MessageItemType
+    Message, MessageRecall, MessageItemType,
+    LightModel, LightMessage, LightMessageRecall
 )
 from .misc import argument_signature, raiser, TRACEBACKED
 from .protocol import BiliChat_Protocol
-from .logger import Event, Protocol
+from .entities import User, Group
+from .network import fetch
+from .loader import BatchLoader
+from .cache import EntityCache, DependencyCache, ImageCache
+from .store import MessageStore
+from .scheduler import PollScheduler
+from .workers import HandlerPool, ORDERING_TALKER, ORDERING_RECEIVER
+from .sender import SendDispatcher, TokenBucket
+from .checkpoint import Checkpoint
+from .routing import Route, Router
+from .replay import Recorder
+from .ack import AckWriter
+from .metrics import Metrics
+from .offload import OffloadPool, OFFLOAD_NONE, OFFLOAD_THREAD, OFFLOAD_PROCESS
+from .logger import Event, Network, Protocol, sample_event
+from . import logger
 from .logger import Session as SessionLogger
 
 class BiliChat(BiliChat_Protocol):
     event: Dict[
         str, List[Callable[[Any], Awaitable]]
-    ] = {}
-    lifecycle: Dict[str, List[Callable]] = {
-        "start": [],
-        "end": [],
-        "around": []
-    }
+    ]
+    lifecycle: Dict[str, List[Callable]]
     global_dependencies: List[Depend]
     global_middlewares: List
 
     def __init__(self,
                  cookies,
                  global_dependencies: List[Depend] = None,
-                 global_middlewares: List = None):
+                 global_middlewares: List = None,
+                 network: fetch = None,
+                 session_concurrency: int = 8,
+                 user_batch_window: float = 0.05,
+                 user_batch_size: int = 50,
+                 user_cache: EntityCache = None,
+                 group_cache: EntityCache = None,
+                 message_capacity: int = 10000,
+                 message_max_age: float = None,
+                 poll_scheduler: PollScheduler = None,
+                 depend_cache_size: int = 10000,
+                 handler_pool: HandlerPool = None,
+                 queue_size: int = 1024,
+                 send_dispatcher: SendDispatcher = None,
+                 image_cache: ImageCache = None,
+                 light_models: bool = False,
+                 metrics: Metrics = None,
+                 offload_pool: OffloadPool = None,
+                 checkpoint: Checkpoint = None,
+                 catchup_rate: float = 5,
+                 page_size: int = 5,
+                 max_page_size: int = 50,
+                 read_ahead: int = 200,
+                 recorder: Recorder = None,
+                 warm_start: bool = False,
+                 warm_start_concurrency: int = 4,
+                 warm_start_sessions: int = 2000,
+                 entity_snapshot: str = None,
+                 ack_delay: float = 1.0,
+                 baseurl: str = "https://api.vc.bilibili.com",
+                 upload_url: str = "https://api.bilibili.com/x/dynamic/feed/draw/upload_bfs"):
+        self.event = {} # 每个实例独立的处理器注册表
+        self.lifecycle = {
+            "start": [],
+            "end": [],
+            "around": []
+        }
         self.global_dependencies = global_dependencies or []
         self.global_middlewares = global_middlewares or []
+        self._dispatch_table = None
+        self._annotations_mapping = None
+        self._tasks: List[asyncio.Task] = []
         self.cookies = dict([l.split("=", 1) for l in cookies.split("; ")])
-        self.baseurl = "https://api.vc.bilibili.com"
+        self.baseurl = baseurl
+        self.upload_url = upload_url
         self.session_ts = int(round(time.time() * 1000000))
+        self.metrics = metrics or Metrics()
+        self.network = network or fetch()
+        if self.network.metrics is None:
+            self.network.metrics = self.metrics
+        self.recorder = recorder
+        if recorder is not None and self.network.recorder is None:
+            self.network.recorder = recorder
+        elif recorder is not None and self.network.recorder is not recorder: # 共享连接池由宿主录制
+            Network.warning("network already has a recorder, this bot's recorder will stay empty")
+        self.session_concurrency = session_concurrency
+        self.max_ack_list = {}
+        self.user_loader = BatchLoader(self.getUserDetails, window=user_batch_window, max_batch=user_batch_size)
 
-        self.message_list = []
-        self.user_list = {}
-        self.group_list = {}
+        self.poll_scheduler = poll_scheduler or PollScheduler()
+        self.message_types = {
+            1: LightMessage if light_models else Message, # 文本
+            2: LightMessage if light_models else Message, # 图片
+            5: LightMessageRecall if light_models else MessageRecall # 撤回
+        }
+        self.handler_pool = handler_pool or HandlerPool()
+        self.queue_size = queue_size
+        self.send_dispatcher = send_dispatcher or SendDispatcher()
+        self.image_cache = image_cache if image_cache is not None else ImageCache()
+        self.offload_pool = offload_pool or OffloadPool()
+        self.checkpoint = checkpoint # 设置后持久化 seqno，重启时从断点继续
+        self.catchup_rate = catchup_rate # 补齐积压会话时每秒拉取的会话数
+        self.page_size = page_size # fetch_session_msgs 的初始分页大小
+        self.max_page_size = max_page_size
+        self.read_ahead = read_ahead # 单个会话每轮最多读取的消息数，超出部分留到下一轮
+        self.page_sizes: Dict[int, int] = {} # 仅记录积压较多的会话
+        self.pending_sessions: Dict[int, dict] = {} # 上一轮未读完的会话
+        self.session_locks: Dict[int, asyncio.Lock] = {} # 同一会话的轮询与补齐任务串行读取
+        self.session_since: Dict[int, int] = {} # 从头补齐的会话只投递该时间（微秒）之后的消息
+        self.warm_start = warm_start # 启动后在后台预取所有会话的用户与应援团信息
+        self.warm_start_concurrency = warm_start_concurrency
+        self.warm_start_sessions = warm_start_sessions # 最多翻页读取的会话数
+        self.entity_snapshot = Path(entity_snapshot) if entity_snapshot is not None else None
+        self.ack_writer = AckWriter(self.updateAck, delay=ack_delay) # 已读回执在后台合并发送
+        self.session_depend_cache = DependencyCache(maxsize=depend_cache_size)
+        self.global_depend_cache = DependencyCache(maxsize=depend_cache_size)
+        self.message_list = MessageStore(capacity=message_capacity, max_age=message_max_age)
+        self.user_list = user_cache if user_cache is not None else EntityCache()
+        self.group_list = group_cache if group_cache is not None else EntityCache()
+        if self.user_list.loader is None:
+            self.user_list.loader = self.getUserDetail
+        if self.group_list.loader is None:
+            self.group_list.loader = self.getGroupDetail
+        self.metrics.register_collector(self.collect_metrics)
 
     async def http_event(self):
-        async with aiohttp.ClientSession() as session:
-            max_ack_list = {}
-            async with session.get(f"{self.baseurl}/session_svr/v1/session_svr/get_sessions", params={
-                "session_type": 4, # 1: 私聊, 2: 通知, 3: 应援团, 4: 全部
-                "group_fold": 1,
-                "unfollow_fold": 0,
-                "sort_rule": 2,
-                "build": 0,
-                "mobi_app": "web"
-            }, cookies=self.cookies) as res: # 获取最新最热最潮 seqno
-                received_data = await res.json()
-                for _session in received_data["data"]["session_list"]:
-                    max_ack_list[_session["talker_id"]] = _session["max_seqno"]
-            Protocol.info(f"Connected to uid: {self.cookies['DedeUserID']}")
-            while True: # 开始轮询
-                session_list = []
-                async with session.get(f"{self.baseurl}/session_svr/v1/session_svr/new_sessions", params={
+        restored = self.checkpoint is not None and await self.checkpoint.restore(self.cookies['DedeUserID'])
+        if self.entity_snapshot is not None:
+            await self.load_entities()
+        sessions = await self.connect() # 获取最新最热最潮 seqno
+        backlog = []
+        for _session in sessions["session_list"] or []:
+            talker_id = _session["talker_id"]
+            ack_seqno = self.checkpoint.acks.get(talker_id) if restored else None
+            if restored and ack_seqno is None and _session.get("session_ts", 0) > self.checkpoint.session_ts:
+                # 不在 checkpoint 中但停机期间有新消息：从头读取，只投递上次运行之后的消息
+                ack_seqno = 0
+                self.session_since[talker_id] = self.checkpoint.session_ts
+            if ack_seqno is not None and ack_seqno < _session["max_seqno"]:
+                self.max_ack_list[talker_id] = ack_seqno
+                backlog.append(_session)
+            else:
+                self.max_ack_list[talker_id] = _session["max_seqno"]
+                if self.checkpoint is not None: # 记录起点，下次重启时不在 checkpoint 中的会话才是新会话
+                    self.checkpoint.mark(talker_id, _session["max_seqno"])
+        if restored: # 不在第一页的会话同样从 checkpoint 继续，而不是当作新会话跳到 max_seqno
+            for talker_id, ack_seqno in self.checkpoint.acks.items():
+                self.max_ack_list.setdefault(talker_id, ack_seqno)
+        Protocol.info(f"Connected to uid: {self.cookies['DedeUserID']}")
+        if self.checkpoint is not None:
+            self.checkpoint.set_session_ts(self.session_ts)
+            self.checkpoint.start()
+        if backlog:
+            Protocol.info(f"catching up {len(backlog)} sessions since last checkpoint")
+            self.spawn(self.catch_up(backlog), "catch_up")
+        if self.warm_start:
+            self.spawn(self.warm_up(sessions), "warm_up")
+        await self.poll_scheduler.stagger() # 多账号时错开各自的轮询时刻
+        while True: # 开始轮询
+            poll_started = time.perf_counter()
+            session_list = []
+            try:
+                received_data = await self.network.http_get(f"{self.baseurl}/session_svr/v1/session_svr/new_sessions", params={
                     "begin_ts": self.session_ts,
                     "build": 0,
                     "mobi_app": "web"
-                }, cookies=self.cookies) as res: # 获取有新消息的会话（该接口只有一条最新消息）
-                    try:
-                        received_data = await res.json()
-                    except TypeError:
-                        continue
-                    if received_data:
-                        if received_data['data']['session_list'] is not None:
-                            self.session_ts = int(round(time.time() * 1000000))
-                            session_list = received_data['data']['session_list']
-                
-                for _session in session_list: # 获取新消息会话的多条消息
-                    talker_id = _session["talker_id"]
-                    ack_seqno = max_ack_list.get(talker_id) # 无视机器人开启前的消息
-                    if ack_seqno is None: # 新会话
-                        ack_seqno = _session["max_seqno"]
-                    max_ack_list[talker_id] = _session["max_seqno"]
-                    async with session.post(f"{self.baseurl}/svr_sync/v1/svr_sync/update_ack", params={
-                        "talker_id": talker_id,
-                        "session_type": _session["session_type"],
-                        "ack_seqno": ack_seqno,
-                        "build": 0,
-                        "mobi_app": "web",
-                        'csrf_token': self.cookies['bili_jct'],
-                        'csrf': self.cookies['bili_jct']
-                    }, cookies=self.cookies) as res: # 已读
-                        try:
-                            received_data = await res.json()
-                        except TypeError:
-                            continue
-                    async with session.get(f"{self.baseurl}/svr_sync/v1/svr_sync/fetch_session_msgs", params={
-                        "sender_device_id": 1,
-                        "talker_id": talker_id,
-                        "session_type": _session["session_type"],
-                        "size": 5,
-                        "begin_seqno": ack_seqno,
-                        "build": 0,
-                        "mobi_app": "web"
-                    }, cookies=self.cookies) as res:
-                        try:
-                            received_data = await res.json()
-                        except TypeError:
-                            continue
-                        if received_data:
-                            if received_data['data']['messages'] is not None:
-                                for _message in received_data['data']['messages']:
-                                    message_type_list = {
-                                        1: Message, # 文本
-                                        2: Message, # 图片
-                                        5: MessageRecall # 撤回
-                                    }
-                                    message = message_type_list[_message["msg_type"]].parse_obj(_message)
-
-                                    user_id = message.sender_uid
-                                    if message.receiver_type == 2: # 应援团
-                                        group_id = message.receiver_id
-                                        if group_id not in self.group_list:
-                                            self.group_list[group_id] = await self.getGroupDetail(group_id)
-                                    if user_id not in self.user_list:
-                                        self.user_list[user_id] = await self.getUserDetail(user_id)
-                                    self.message_list.append(message)
-                                    await self.queue.put(InternalEvent(
-                                        name=self.getEventCurrentName(type(message)),
-                                        body=message
-                                    ))
-                await asyncio.sleep(2) # 每 2 秒轮询一次
+                }, cookies=self.cookies) # 获取有新消息的会话（该接口只有一条最新消息）
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                Network.error(f"polling new_sessions failed: {e.__class__.__name__}")
+                received_data = None
+            if received_data and received_data.get("code", 0) != 0:
+                Network.error(f"polling new_sessions returned code {received_data.get('code')}: {received_data.get('message')}")
+            elif received_data and received_data.get("data"):
+                if received_data['data'].get('session_list') is not None:
+                    self.session_ts = int(round(time.time() * 1000000))
+                    session_list = received_data['data']['session_list']
+            if self.pending_sessions: # 继续读取上一轮未读完的会话
+                polled = {_session["talker_id"] for _session in session_list}
+                session_list = session_list + [
+                    _session for talker_id, _session in self.pending_sessions.items() if talker_id not in polled
+                ]
+                self.pending_sessions = {}
+            self.poll_scheduler.record(bool(session_list))
+
+            if session_list: # 并发获取新消息会话的多条消息
+                semaphore = asyncio.Semaphore(self.session_concurrency)
+                results = await asyncio.gather(*[
+                    self.fetch_session(_session, semaphore) for _session in session_list
+                ], return_exceptions=True)
+                for _session, result in zip(session_list, results):
+                    if isinstance(result, Exception):
+                        Network.error(f"handling session {_session['talker_id']} raised a error: {result.__class__.__name__}")
+            if session_list and self.checkpoint is not None:
+                self.checkpoint.set_session_ts(self.session_ts)
+            self.metrics.observe("bilichat_poll_seconds", time.perf_counter() - poll_started)
+            await self.poll_scheduler.wait() # 会话活跃时加快轮询，空闲时逐步退避
+
+    async def connect(self) -> dict:
+        # 接口出错或被拦截（data 为 null）时按轮询间隔退避重试，直到拿到会话列表
+        while True:
+            try:
+                sessions = await self.getSessions()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                Network.error(f"getting sessions failed: {e.__class__.__name__}")
+            else:
+                if sessions is not None:
+                    return sessions
+                Network.error("getting sessions failed: empty response")
+            self.poll_scheduler.record(False)
+            await self.poll_scheduler.wait()
+
+    async def fetch_session(self, _session, semaphore: asyncio.Semaphore):
+        lock = self.session_locks.get(_session["talker_id"])
+        if lock is None:
+            lock = self.session_locks[_session["talker_id"]] = asyncio.Lock()
+        async with lock:
+            await self.read_session(_session, semaphore)
+
+    async def read_session(self, _session, semaphore: asyncio.Semaphore):
+        talker_id = _session["talker_id"]
+        ack_seqno = self.max_ack_list.get(talker_id) # 无视机器人开启前的消息
+        if ack_seqno is None: # 新会话
+            ack_seqno = _session["max_seqno"]
+        elif ack_seqno >= _session["max_seqno"]: # 已由轮询或补齐任务处理
+            return
+        self.max_ack_list[talker_id] = _session["max_seqno"]
+        async with semaphore, self.metrics.timer("bilichat_session_fetch_seconds"):
+            raw_messages, fetched_seqno, complete = await self.fetch_session_pages(_session, ack_seqno)
+            if not complete: # 读取上限或请求失败，剩余部分在下一轮轮询继续
+                if self.max_ack_list.get(talker_id) == _session["max_seqno"]:
+                    self.max_ack_list[talker_id] = fetched_seqno
+                self.pending_sessions[talker_id] = _session
+            messages = self.parse_messages(raw_messages)
+            since = self.session_since.get(talker_id)
+            if since is not None: # timestamp 精确到秒，同一秒内的消息保留，由 checkpoint.seen 去重
+                messages = [message for message in messages if (message.timestamp + 1) * 1000000 > since]
+                if complete:
+                    del self.session_since[talker_id]
+            await self.prefetch_entities(messages)
+        # 入队可能因队列已满而等待，不占用并发名额
+        await self.enqueue_messages(talker_id, messages)
+        read_seqno = _session["max_seqno"] if complete else fetched_seqno
+        if read_seqno > ack_seqno: # 已读
+            self.ack_writer.ack(talker_id, _session["session_type"], read_seqno)
+        if self.checkpoint is not None:
+            self.checkpoint.mark(talker_id, read_seqno)
+
+    def parse_messages(self, raw_messages) -> list:
+        message_type_list = self.message_types
+        messages = [
+            message_type_list[_message["msg_type"]].parse_obj(_message)
+            for _message in raw_messages
+            if _message["msg_type"] in message_type_list
+        ]
+        messages.sort(key=lambda message: message.msg_seqno) # 保证同一会话内按 seqno 投递
+        return messages
+
+    async def prefetch_entities(self, messages):
+        group_ids = list({message.receiver_id for message in messages if message.receiver_type == 2}) # 应援团
+        user_ids = list({message.sender_uid for message in messages})
+        # 缓存未命中的用户查询会在同一轮询中被 user_loader 合并为一次请求；
+        # 预取只是尽力而为，失败时消息照常投递，日志与 Sender 会处理缺失的实体
+        results = await asyncio.gather(
+            *[self.group_list.fetch(group_id) for group_id in group_ids],
+            *[self.user_list.fetch(user_id) for user_id in user_ids],
+            return_exceptions=True
+        )
+        for key, result in zip([("group", i) for i in group_ids] + [("user", i) for i in user_ids], results):
+            if isinstance(result, Exception):
+                Network.error(f"prefetching {key[0]} {key[1]} failed: {result.__class__.__name__}")
+
+    async def enqueue_messages(self, talker_id, messages) -> int:
+        enqueued = 0
+        for message in messages:
+            if message.msg_key in self.message_list: # 重复投递
+                continue
+            if self.checkpoint is not None and self.checkpoint.seen(message.msg_key): # 重启前已投递
+                continue
+            self.message_list.append(message, talker_id)
+            done = None
+            if self.checkpoint is not None: # 处理器全部执行完后才计入 checkpoint
+                self.checkpoint.begin(talker_id, message.msg_seqno)
+                done = functools.partial(self.checkpoint.complete, talker_id, message.msg_seqno, message.msg_key)
+            await self.queue.put(InternalEvent(
+                name=self.getEventCurrentName(type(message)),
+                body=message,
+                created=time.monotonic(),
+                done=done
+            ))
+            enqueued += 1
+        return enqueued
+
+    async def fetch_session_pages(self, _session, begin_seqno: int):
+        # 从 begin_seqno 起按 has_more 逐页读取，返回 (消息, 已读取到的 seqno, 是否读完)
+        talker_id = _session["talker_id"]
+        size = self.page_sizes.get(talker_id, self.page_size)
+        raw_messages = []
+        while True:
+            try:
+                received_data = await self.network.http_get(f"{self.baseurl}/svr_sync/v1/svr_sync/fetch_session_msgs", params={
+                    "sender_device_id": 1,
+                    "talker_id": talker_id,
+                    "session_type": _session["session_type"],
+                    "size": size,
+                    "begin_seqno": begin_seqno,
+                    "build": 0,
+                    "mobi_app": "web"
+                }, cookies=self.cookies)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                Network.error(f"fetching session {talker_id} failed: {e.__class__.__name__}")
+                return raw_messages, begin_seqno, False
+            if not received_data or received_data.get("data") is None:
+                return raw_messages, begin_seqno, False
+            page = received_data["data"]["messages"]
+            if not page:
+                break
+            raw_messages.extend(page)
+            begin_seqno = max(begin_seqno, max(_message["msg_seqno"] for _message in page))
+            if not received_data["data"].get("has_more"):
+                break
+            if len(raw_messages) >= self.read_ahead: # 单个会话每轮最多读取的消息数
+                self.page_sizes[talker_id] = self.max_page_size
+                return raw_messages, begin_seqno, False
+            size = min(size * 2, self.max_page_size) # 积压较多时逐页加大
+        # 下一次按本次观察到的积压量请求
+        if len(raw_messages) > self.page_size:
+            self.page_sizes[talker_id] = min(len(raw_messages), self.max_page_size)
+        else:
+            self.page_sizes.pop(talker_id, None)
+        return raw_messages, begin_seqno, True
+
+    async def catch_up(self, sessions):
+        # 按限定速率补齐停机期间的积压，避免启动时集中请求
+        bucket = TokenBucket(self.catchup_rate, 1)
+        semaphore = asyncio.Semaphore(self.session_concurrency)
+        async def fetch(_session):
+            await bucket.acquire()
+            await self.fetch_session(_session, semaphore)
+        results = await asyncio.gather(*[fetch(_session) for _session in sessions], return_exceptions=True)
+        for _session, result in zip(sessions, results):
+            if isinstance(result, Exception):
+                Network.error(f"catching up session {_session['talker_id']} raised a error: {result.__class__.__name__}")
+        Protocol.info(f"caught up {len(sessions)} sessions")
+
+    async def warm_up(self, sessions: dict):
+        started = time.perf_counter()
+        page = sessions["session_list"] or []
+        session_list = list(page)
+        has_more = sessions.get("has_more")
+        while has_more and page and len(session_list) < self.warm_start_sessions:
+            try:
+                sessions = await self.getSessions(end_ts=min(_session["session_ts"] for _session in page))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                Network.error(f"paging sessions failed: {e.__class__.__name__}")
+                break
+            if sessions is None:
+                Network.error("paging sessions failed: empty response")
+                break
+            page = sessions["session_list"] or []
+            for _session in page: # 较早的会话同样以当前 seqno 为起点
+                if _session["talker_id"] not in self.max_ack_list:
+                    self.max_ack_list[_session["talker_id"]] = _session["max_seqno"]
+                    if self.checkpoint is not None:
+                        self.checkpoint.mark(_session["talker_id"], _session["max_seqno"])
+            session_list.extend(page)
+            has_more = sessions.get("has_more") and page
+
+        user_ids, group_ids = set(), set()
+        for _session in session_list:
+            if _session["session_type"] == 2: # 应援团
+                group_ids.add(_session["talker_id"])
+                sender_uid = (_session.get("last_msg") or {}).get("sender_uid")
+                if sender_uid:
+                    user_ids.add(sender_uid)
+            else:
+                user_ids.add(_session["talker_id"])
+        user_ids = [user_id for user_id in user_ids if user_id not in self.user_list]
+        group_ids = [group_id for group_id in group_ids if group_id not in self.group_list]
+
+        semaphore = asyncio.Semaphore(self.warm_start_concurrency)
+        batch_size = self.user_loader.max_batch
+        async def load_users(batch):
+            async with semaphore:
+                users = await self.getUserDetails(batch)
+            for user_id, user in users.items():
+                self.user_list.set(user_id, user)
+        async def load_group(group_id):
+            async with semaphore:
+                self.group_list.set(group_id, await self.getGroupDetail(group_id))
+        results = await asyncio.gather(
+            *[load_users(user_ids[i:i + batch_size]) for i in range(0, len(user_ids), batch_size)],
+            *[load_group(group_id) for group_id in group_ids],
+            return_exceptions=True
+        )
+        failed = sum(isinstance(result, Exception) for result in results)
+        Protocol.info(
+            f"warmed up {len(user_ids)} users and {len(group_ids)} groups from {len(session_list)} sessions "
+            f"in {time.perf_counter() - started:.2f}s ({failed} requests failed)"
+        )
+        if self.entity_snapshot is not None:
+            await self.save_entities()
+
+    async def load_entities(self):
+        def load():
+            try:
+                return json.loads(self.entity_snapshot.read_text(encoding="utf-8"))
+            except FileNotFoundError:
+                return None
+        try:
+            snapshot = await asyncio.get_running_loop().run_in_executor(None, load)
+        except (OSError, ValueError) as e:
+            Protocol.warning(f"loading entity snapshot {self.entity_snapshot} failed: {e.__class__.__name__}")
+            return
+        if snapshot:
+            users = self.user_list.restore(snapshot.get("users", []), User.parse_obj)
+            groups = self.group_list.restore(snapshot.get("groups", []), Group.parse_obj)
+            Protocol.info(f"restored {users} users and {groups} groups from {self.entity_snapshot}")
+
+    async def save_entities(self):
+        snapshot = {
+            "users": self.user_list.snapshot(lambda user: user.dict()),
+            "groups": self.group_list.snapshot(lambda group: group.dict())
+        }
+        def save():
+            temp = self.entity_snapshot.with_suffix(self.entity_snapshot.suffix + ".tmp")
+            temp.write_text(json.dumps(snapshot, ensure_ascii=False), encoding="utf-8")
+            temp.replace(self.entity_snapshot)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, save)
+        except OSError as e:
+            Protocol.warning(f"saving entity snapshot {self.entity_snapshot} failed: {e.__class__.__name__}")
 
     async def event_runner(self):
         while True:
@@ -137,25 +460,110 @@ class BiliChat(BiliChat_Protocol):
                 event_context: NamedTuple[InternalEvent] = await asyncio.wait_for(self.queue.get(), 3)
             except asyncio.TimeoutError:
                 continue
-            
-            if event_context.name in self.registeredEventNames:
-                for event_body in list(self.event.values()) \
-                        [self.registeredEventNames.index(event_context.name)]:
-                    if event_body:
-                        if event_context.name == "Message":
-                            msg_type = event_context.body.msg_type
-                            member = self.user_list[event_context.body.sender_uid]
-                            if msg_type == 1:
-                                content = event_context.body.content['content']
-                            elif msg_type == 2:
-                                content = "[图片]"
-                            if event_context.body.receiver_type == 1:
-                                Event.info(f"{member.uname} -> {content}")
-                            elif event_context.body.receiver_type == 2:
-                                group = self.group_list[event_context.body.receiver_id]
-                                Event.info(f"{group.group_name} - {member.uname} -> {content}")
-                        running_loop = asyncio.get_running_loop()
-                        running_loop.create_task(self.executor(event_body, event_context))
+            try:
+                await self.dispatch_event(event_context)
+            except Exception as e: # 单个事件出错（如消息内容无法解析）不能让 event_runner 退出
+                Event.exception(f"dispatching event {event_context.name} raised a error: {e.__class__.__name__}")
+                if event_context.done is not None: # 无法处理的消息不应阻塞该会话的 checkpoint
+                    event_context.done()
+
+    async def dispatch_event(self, event_context):
+        if self.metrics.enabled:
+            self.metrics.set_gauge("bilichat_queue_depth", self.queue.qsize())
+            if event_context.created is not None:
+                self.metrics.observe("bilichat_event_age_seconds", time.monotonic() - event_context.created)
+        router = self.dispatch_table.get(event_context.name)
+        handlers = router.match(event_context.body) if router is not None else () # 只为可能匹配的处理器创建任务
+        if not handlers:
+            if event_context.done is not None:
+                event_context.done()
+            return
+        if event_context.name == "Message":
+            self.log_message(event_context.body)
+        depend_cache = DependencyCache() # 同一事件的所有处理器共享依赖结果
+        ordering_key = self.getOrderingKey(event_context.body)
+        jobs = [
+            functools.partial(self.executor, event_body, event_context, depend_cache=depend_cache)
+            for event_body in handlers
+        ]
+        if event_context.done is not None:
+            jobs = self.track_completion(jobs, event_context.done)
+        for job in jobs: # 线程池已满时在此等待，进而让 self.queue 对 http_event 形成背压
+            await self.handler_pool.submit(job, ordering_key)
+
+    @staticmethod
+    def track_completion(jobs: list, done: Callable[[], Any]) -> list:
+        # 最后一个处理器结束（无论成功与否）时调用 done；被取消的不算，重启后会重新投递
+        remaining = len(jobs)
+        async def tracked(job):
+            nonlocal remaining
+            try:
+                return await job()
+            except asyncio.CancelledError:
+                remaining = None
+                raise
+            finally:
+                if remaining is not None:
+                    remaining -= 1
+                    if not remaining:
+                        done()
+        return [functools.partial(tracked, job) for job in jobs]
+
+    def collect_metrics(self):
+        for name, cache in (
+            ("user", self.user_list),
+            ("group", self.group_list),
+            ("depend_session", self.session_depend_cache),
+            ("depend_global", self.global_depend_cache),
+            ("image", self.image_cache)
+        ):
+            stats = cache.stats()
+            yield "bilichat_cache_hits", {"cache": name}, stats["hits"]
+            yield "bilichat_cache_misses", {"cache": name}, stats["misses"]
+            yield "bilichat_cache_hit_rate", {"cache": name}, stats["hit_rate"]
+        yield "bilichat_message_store_size", {}, len(self.message_list)
+        for key, value in self.poll_scheduler.stats().items():
+            yield f"bilichat_poll_{key}", {}, value
+        for key, value in self.handler_pool.stats().items():
+            yield f"bilichat_handler_pool_{key}", {}, value
+        for key, value in self.send_dispatcher.stats().items():
+            yield f"bilichat_send_{key}", {}, value
+        for key, value in self.offload_pool.stats().items():
+            yield f"bilichat_offload_{key}", {}, value
+        for key, value in logger.stats().items():
+            yield f"bilichat_log_{key}", {}, value
+        for key, value in self.ack_writer.stats().items():
+            yield f"bilichat_ack_{key}", {}, value
+        if self.checkpoint is not None:
+            for key, value in self.checkpoint.stats().items():
+                yield f"bilichat_checkpoint_{key}", {}, value
+
+    def log_message(self, message: Message):
+        if not sample_event(): # 在格式化之前采样
+            return
+        member = self.user_list.get(message.sender_uid)
+        uname = member.uname if member else message.sender_uid
+        if message.msg_type == 1:
+            content = message.content['content']
+        elif message.msg_type == 2:
+            content = "[图片]"
+        if message.receiver_type == 1:
+            Event.info(f"{uname} -> {content}")
+        elif message.receiver_type == 2:
+            group = self.group_list.get(message.receiver_id)
+            group_name = group.group_name if group else message.receiver_id
+            Event.info(f"{group_name} - {uname} -> {content}")
+
+    @property
+    def dispatch_table(self) -> Dict[str, Router]:
+        # 仅在注册变化时重建，事件分发只需一次字典查找与一次路由匹配
+        if self._dispatch_table is None:
+            merged = {}
+            for event_name, handlers in self.event.items():
+                name = self.getEventCurrentName(event_name)
+                merged[name] = merged.get(name, ()) + tuple(handlers)
+            self._dispatch_table = {name: Router(handlers) for name, handlers in merged.items()}
+        return self._dispatch_table
 
     @property
     def registeredEventNames(self):
@@ -165,124 +573,254 @@ class BiliChat(BiliChat_Protocol):
                        executor_protocol: ExecutorProtocol,
                        event_context,
                        extra_parameter={},
-                       lru_cache_sets=None
+                       depend_cache: DependencyCache = None
                        ):
-        lru_cache_sets = lru_cache_sets or {}
-        executor_protocol: ExecutorProtocol
-        for depend in executor_protocol.dependencies:
-            if not inspect.isclass(depend.func):
-                depend_func = depend.func
-            elif hasattr(depend.func, "__call__"):
-                depend_func = depend.func.__call__
-            else:
-                raise TypeError("must be callable.")
+        plan = executor_protocol.plan or self.compile_executor(executor_protocol)
+        if depend_cache is None:
+            depend_cache = DependencyCache()
+        if not self.metrics.enabled:
+            return await self.execute_plan(plan, event_context, extra_parameter, depend_cache)
+        with self.metrics.timer("bilichat_handler_seconds", handler=plan.callable.__qualname__):
+            return await self.execute_plan(plan, event_context, extra_parameter, depend_cache)
 
-            if depend_func in lru_cache_sets and depend.cache:
-                depend_func = lru_cache_sets[depend_func]
-            else:
-                if depend.cache:
-                    original = depend_func
-                    if inspect.iscoroutinefunction(depend_func):
-                        depend_func = alru_cache(depend_func)
-                    else:
-                        depend_func = lru_cache(depend_func)
-                    lru_cache_sets[original] = depend_func
-
-            result = await self.executor_with_middlewares(
-                depend_func, depend.middlewares, event_context, lru_cache_sets
-            )
-            if result is TRACEBACKED:
+    async def execute_plan(self, plan: CallPlan, event_context, extra_parameter={}, depend_cache: DependencyCache = None):
+        if plan.dependencies: # 相互独立的依赖并发执行
+            results = await asyncio.gather(*[
+                self.resolve_depend(depend_plan, event_context, depend_cache)
+                for depend_plan in plan.dependencies
+            ])
+            if any(result is TRACEBACKED for result in results):
                 return TRACEBACKED
 
-        ParamSignatures = argument_signature(executor_protocol.callable)
-        PlaceAnnotation = self.get_annotations_mapping()
         CallParams = {}
-        for name, annotation, default in ParamSignatures:
+        depend_params = []
+        for name, kind, source in plan.parameters:
+            if kind is PARAM_ANNOTATION:
+                CallParams[name] = source(event_context)
+            elif kind is PARAM_DEPEND:
+                depend_params.append((name, source))
+            elif name not in extra_parameter:
+                raise RuntimeError(f"checked a unexpected annotation: {source}")
+        if depend_params:
+            results = await asyncio.gather(*[
+                self.resolve_depend(source, event_context, depend_cache)
+                for _, source in depend_params
+            ])
+            CallParams.update(zip([name for name, _ in depend_params], results))
+
+        async with AsyncExitStack() as stack:
+            for async_middleware in plan.middlewares['async']:
+                await stack.enter_async_context(async_middleware)
+            for normal_middleware in plan.middlewares['normal']:
+                stack.enter_context(normal_middleware)
+
+            if plan.offload: # 参数在事件循环中解析完毕后整体提交到池中
+                return await self.offload_pool.run(
+                    functools.partial(plan.callable, **CallParams, **extra_parameter),
+                    mode=plan.offload
+                )
+            return await self.run_func(plan.callable, **CallParams, **extra_parameter)
+
+    async def resolve_depend(self, plan: CallPlan, event_context, depend_cache: DependencyCache = None):
+        if depend_cache is None:
+            depend_cache = DependencyCache()
+        async def factory():
+            if not self.metrics.enabled:
+                return await self.execute_plan(plan, event_context, depend_cache=depend_cache)
+            with self.metrics.timer("bilichat_depend_seconds", depend=getattr(plan.callable, "__qualname__", repr(plan.callable))):
+                return await self.execute_plan(plan, event_context, depend_cache=depend_cache)
+        if plan.cache is None:
+            return await factory()
+        scope, ttl = plan.cache
+        if scope == SCOPE_EVENT:
+            return await depend_cache.resolve(plan.callable, factory)
+        elif scope == SCOPE_SESSION:
+            key = (plan.callable, self.getTalkerId(event_context.body))
+            return await self.session_depend_cache.resolve(key, factory, ttl)
+        return await self.global_depend_cache.resolve(plan.callable, factory, ttl)
+
+    def compile_executor(self, executor_protocol: ExecutorProtocol) -> CallPlan:
+        return self.compile_plan(
+            executor_protocol.callable,
+            executor_protocol.dependencies,
+            executor_protocol.middlewares,
+            executor_protocol.offload
+        )
+
+    def compile_plan(self, func: Callable, dependencies: List[Depend] = (), middlewares: List = (), offload: str = OFFLOAD_NONE) -> CallPlan:
+        PlaceAnnotation = self.annotations_mapping
+        parameters = []
+        for name, annotation, default in argument_signature(func):
+            if offload == OFFLOAD_PROCESS and annotation is BiliChat:
+                raise TypeError("BiliChat cannot be passed into a process pool, return the result to a coroutine handler instead.")
             if default:
                 if isinstance(default, Depend):
-                    if not inspect.isclass(default.func):
-                        depend_func = default.func
-                    elif hasattr(default.func, "__call__"):
-                        depend_func = default.func.__call__
-                    else:
-                        raise TypeError("must be callable.")
-
-                    if depend_func in lru_cache_sets and default.cache:
-                        depend_func = lru_cache_sets[depend_func]
-                    else:
-                        if default.cache:
-                            original = depend_func
-                            if inspect.iscoroutinefunction(depend_func):
-                                depend_func = alru_cache(depend_func)
-                            else:
-                                depend_func = lru_cache(depend_func)
-                            lru_cache_sets[original] = depend_func
-
-                    CallParams[name] = await self.executor_with_middlewares(
-                        depend_func, default.middlewares, event_context, lru_cache_sets
-                    )
-                    continue
+                    parameters.append((name, PARAM_DEPEND, self.compile_depend(default)))
                 else:
                     raise RuntimeError("checked a unexpected default value.")
-            else:
-                if annotation in PlaceAnnotation:
-                    CallParams[name] = PlaceAnnotation[annotation](event_context)
-                    continue
-                else:
-                    if name not in extra_parameter:
-                        raise RuntimeError(f"checked a unexpected annotation: {annotation}")
+            elif annotation in PlaceAnnotation:
+                parameters.append((name, PARAM_ANNOTATION, PlaceAnnotation[annotation]))
+            else: # 只能由 extra_parameter 提供
+                parameters.append((name, PARAM_EXTRA, annotation))
 
-        async with AsyncExitStack() as stack:
-            sorted_middlewares = self.sort_middlewares(executor_protocol.middlewares)
-            for async_middleware in sorted_middlewares['async']:
-                await stack.enter_async_context(async_middleware)
-            for normal_middleware in sorted_middlewares['normal']:
-                stack.enter_context(normal_middleware)
+        return CallPlan(
+            callable=func,
+            dependencies=tuple(self.compile_depend(depend) for depend in dependencies),
+            parameters=tuple(parameters),
+            middlewares=self.sort_middlewares(middlewares),
+            offload=offload
+        )
+
+    def compile_depend(self, depend: Depend) -> CallPlan:
+        if not inspect.isclass(depend.func):
+            depend_func = depend.func
+        elif hasattr(depend.func, "__call__"):
+            depend_func = depend.func.__call__
+        else:
+            raise TypeError("must be callable.")
+        if depend.offload and inspect.iscoroutinefunction(depend_func): # 池中执行只会得到未 await 的协程对象
+            raise TypeError("offloaded dependency must be a plain function.")
+
+        plan = self.compile_plan(depend_func, middlewares=depend.middlewares, offload=depend.offload)
+        if depend.cache:
+            plan = plan._replace(cache=(depend.scope, depend.ttl))
+        return plan
+
+    async def start(self, poll: bool = True):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = []
+        self.spawn(self.event_runner(), "event_runner")
+        if poll: # 回放时不轮询
+            self.spawn(self.http_event(), "http_event")
+        await self.metrics.start()
+
+    def spawn(self, coro, name: str) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro, name=name)
+        task.add_done_callback(self._task_done)
+        self._tasks.append(task)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None: # 后台任务异常退出时至少留下日志，否则轮询停止而毫无提示
+            SessionLogger.error(
+                f"background task {task.get_name()} raised a error: {error.__class__.__name__}",
+                exc_info=(type(error), error, error.__traceback__)
+            )
+
+    async def close(self, close_network: bool = True):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.handler_pool.close()
+        await self.send_dispatcher.close()
+        await self.offload_pool.close()
+        await self.ack_writer.close()
+        if self.checkpoint is not None:
+            await self.checkpoint.close()
+        if self.recorder is not None: # 等待后台线程写完剩余记录
+            await asyncio.get_running_loop().run_in_executor(None, self.recorder.close)
+        if self.entity_snapshot is not None:
+            await self.save_entities()
+        await self.image_cache.flush()
+        await self.metrics.close()
+        if close_network: # 多账号共享连接池时由宿主关闭
+            await self.network.close()
+
+    async def run_lifecycle(self, *stages: str):
+        for stage in stages:
+            for lifecycle_callable in self.lifecycle[stage]:
+                await self.run_func(lifecycle_callable, self)
 
-            return await self.run_func(executor_protocol.callable, **CallParams, **extra_parameter)
-    
     def run(self):
         loop = asyncio.get_event_loop()
-        self.queue = asyncio.Queue(loop=loop)
-        loop.create_task(self.http_event())
-        loop.create_task(self.event_runner())
         try:
-            for start_callable in self.lifecycle['start']:
-                loop.run_until_complete(self.run_func(start_callable, self))
-
-            for around_callable in self.lifecycle['around']:
-                loop.run_until_complete(self.run_func(around_callable, self))
-
+            loop.run_until_complete(self.start())
+            loop.run_until_complete(self.run_lifecycle("start", "around"))
             loop.run_forever()
         except KeyboardInterrupt:
             SessionLogger.info("catched Ctrl-C, exiting..")
         except Exception as e:
             traceback.print_exc()
         finally:
-            for around_callable in self.lifecycle['around']:
-                loop.run_until_complete(self.run_func(around_callable, self))
-
-            for end_callable in self.lifecycle['end']:
-                loop.run_until_complete(self.run_func(end_callable, self))
+            loop.run_until_complete(self.run_lifecycle("around", "end"))
+            loop.run_until_complete(self.close())
 
     def receiver(self,
                  event_name,
                  dependencies: List[Depend] = None,
-                 use_middlewares: List[Callable] = None):
+                 use_middlewares: List[Callable] = None,
+                 offload: str = OFFLOAD_NONE,
+                 command=None,
+                 regex=None,
+                 receiver_type: int = None,
+                 group_id=None,
+                 sender_id=None):
+        if offload not in (OFFLOAD_NONE, OFFLOAD_THREAD, OFFLOAD_PROCESS):
+            raise ValueError(f"unknown offload mode: {offload}")
+        route = None
+        if any(i is not None for i in (command, regex, receiver_type, group_id, sender_id)):
+            route = Route(command, regex, receiver_type, group_id, sender_id)
         def receiver_warpper(func: Callable):
-            if not inspect.iscoroutinefunction(func):
+            if offload:
+                if inspect.iscoroutinefunction(func):
+                    raise TypeError("offloaded event body must be a plain function.")
+            elif not inspect.iscoroutinefunction(func):
                 raise TypeError("event body must be a coroutine function.")
             
             self.event.setdefault(event_name, [])
-            self.event[event_name].append(ExecutorProtocol(
+            executor_protocol = ExecutorProtocol(
                 callable=func,
                 dependencies=(dependencies or []) + self.global_dependencies,
-                middlewares=(use_middlewares or []) + self.global_middlewares
-            ))
+                middlewares=(use_middlewares or []) + self.global_middlewares,
+                offload=offload,
+                route=route
+            )
+            executor_protocol.plan = self.compile_executor(executor_protocol) # 注册时预先编译调用计划
+            self.event[event_name].append(executor_protocol)
+            self._dispatch_table = None
             return func
 
         return receiver_warpper
 
+    async def offload(self, func: Callable, *args, mode: str = OFFLOAD_PROCESS, **kwargs):
+        return await self.offload_pool.run(func, *args, mode=mode, **kwargs)
+
+    def remove_receiver(self, event_name, func: Callable) -> bool:
+        handlers = self.event.get(event_name, [])
+        remaining = [i for i in handlers if i.callable is not func]
+        if len(remaining) == len(handlers):
+            return False
+        self.event[event_name] = remaining
+        self._dispatch_table = None
+        return True
+
+    def getTalkerId(self, message):
+        if message.receiver_type == 2: # 应援团
+            return message.receiver_id
+        if str(message.sender_uid) == self.cookies['DedeUserID']: # 机器人自己发出的消息
+            return message.receiver_id
+        return message.sender_uid
+
+    def getOrderingKey(self, event_body):
+        if self.handler_pool.ordering == ORDERING_TALKER:
+            return self.getTalkerId(event_body)
+        elif self.handler_pool.ordering == ORDERING_RECEIVER:
+            return event_body.receiver_id
+        return None
+
+    def getMessage(self, msg_key: int):
+        return self.message_list.get(msg_key)
+
+    def getRecalledMessage(self, recall: MessageRecall):
+        return self.message_list.get(recall.content)
+
+    def getRecentMessages(self, talker_id: int, limit: int = None):
+        return self.message_list.recent(talker_id, limit)
+
     def getEventCurrentName(self, event_value):
         class_list = (
             Message,
@@ -290,6 +828,10 @@ class BiliChat(BiliChat_Protocol):
         )
         if isinstance(event_value, class_list):  # normal class
             return event_value.__class__.__name__
+        elif isinstance(event_value, LightModel):  # light model
+            return event_value.__event_name__
+        elif inspect.isclass(event_value) and issubclass(event_value, LightModel):
+            return event_value.__event_name__
         elif event_value in class_list:  # message
             return event_value.__name__
         elif isinstance(event_value, (  # enum
@@ -299,6 +841,12 @@ class BiliChat(BiliChat_Protocol):
         else:
             return event_value
 
+    @property
+    def annotations_mapping(self):
+        if self._annotations_mapping is None:
+            self._annotations_mapping = self.get_annotations_mapping()
+        return self._annotations_mapping
+
     def get_annotations_mapping(self):
         return {
             BiliChat: lambda k: self,
@@ -308,8 +856,8 @@ class BiliChat(BiliChat_Protocol):
             MessageRecall: lambda k: k.body \
                 if self.getEventCurrentName(k.body) == "MessageRecall" else \
                 raiser(ValueError("you cannot setting a unbind argument.")),
-            "Sender": lambda k: k.body.sender \
-                if self.getEventCurrentName(k.body) in MessageTypes else \
+            "Sender": lambda k: self.user_list.get(k.body.sender_uid) \
+                if self.getEventCurrentName(k.body) in ("Message", "MessageRecall") else \
                 raiser(ValueError("Sender is not enable in this type of event.")),
             "Type": lambda k: self.getEventCurrentName(k.body)
         }
@@ -333,7 +881,7 @@ class BiliChat(BiliChat_Protocol):
 
     @staticmethod
     async def run_func(func, *args, **kwargs):
-        if inspect.iscoroutinefunction(func):
-            await func(*args, **kwargs)
-        else:
-            func(*args, **kwargs)
+        result = func(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
@@ -0,0 +1,188 @@
+# 端到端压测：在独立进程中启动模拟接口，驱动 BiliChat 的 http_event -> event_runner -> executor，
+# 统计接收吞吐、消息到处理器的延迟分位数以及内存增长。
+#
+#   python -m bilichat.benchmarks.e2e --talkers 200 --rate 300 --duration 30
+#   python -m bilichat.benchmarks.e2e --duration 10 --restart-after 5 --handler-delay 0.2   # 重启后不丢不重
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+import tracemalloc
+import typing as T
+
+import aiohttp
+
+from ..application import BiliChat
+from ..checkpoint import Checkpoint
+from ..event.models import Message
+from ..scheduler import PollScheduler
+from .fake_server import TrafficProfile, serve_forever
+
+def rss_bytes() -> T.Optional[int]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def memory_bytes(use_tracemalloc: bool) -> T.Optional[int]:
+    return tracemalloc.get_traced_memory()[0] if use_tracemalloc else rss_bytes()
+
+def percentile(values: T.List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def run_benchmark(profile: TrafficProfile,
+                        duration: float = 30,
+                        warmup: float = 2,
+                        use_tracemalloc: bool = False,
+                        restart_after: float = None,
+                        restart_gap: float = 1.0,
+                        handler_delay: float = 0.0,
+                        **bot_options) -> T.Dict[str, T.Any]:
+    # restart_after: 压测进行到该秒数时关闭机器人，restart_gap 秒后以同一 checkpoint 重新启动，
+    # 用于检查重启前后既不丢失也不重复投递；handler_delay 让关闭时仍有处理器在执行
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_forever, args=(profile,), kwargs={"ready": ready}, daemon=True)
+    server.start()
+    url = ready.get(timeout=30)
+
+    checkpoint_dir = tempfile.TemporaryDirectory() if restart_after is not None else None
+    latencies: T.List[float] = []
+    msg_keys: T.Set[int] = set()
+
+    def create_bot() -> BiliChat:
+        options = dict(bot_options)
+        options.setdefault("poll_scheduler", PollScheduler(min_interval=0.05, max_interval=0.5))
+        if checkpoint_dir is not None:
+            options.setdefault("checkpoint", Checkpoint(os.path.join(checkpoint_dir.name, "checkpoint.db"), interval=0.5))
+        bot = BiliChat(
+            "DedeUserID=1; bili_jct=bench; SESSDATA=bench",
+            baseurl=url,
+            upload_url=f"{url}/x/dynamic/feed/draw/upload_bfs",
+            **options
+        )
+
+        @bot.receiver("Message")
+        async def record(message: Message):
+            text = message.content["content"]
+            if text.startswith("bench "):
+                if handler_delay:
+                    await asyncio.sleep(handler_delay)
+                latencies.append(time.time() - float(text[6:]))
+                msg_keys.add(message.msg_key)
+        return bot
+
+    bot = create_bot()
+    if use_tracemalloc:
+        tracemalloc.start()
+    memory_samples: T.List[T.Tuple[float, T.Optional[int]]] = []
+    async with aiohttp.ClientSession() as control:
+        await bot.start()
+        await asyncio.sleep(warmup) # 等待 get_sessions 完成
+        async with control.post(f"{url}/_bench/traffic/start") as response:
+            await response.read()
+        started = time.monotonic()
+        while time.monotonic() - started < duration:
+            memory_samples.append((time.monotonic() - started, memory_bytes(use_tracemalloc)))
+            await asyncio.sleep(1)
+            if restart_after is not None and time.monotonic() - started >= restart_after:
+                restart_after = None
+                await bot.close()
+                await asyncio.sleep(restart_gap)
+                bot = create_bot()
+                await bot.start()
+        async with control.post(f"{url}/_bench/traffic/stop") as response:
+            stats = await response.json()
+        await asyncio.sleep(2) # 处理剩余消息
+        elapsed = time.monotonic() - started
+        await bot.close()
+    if use_tracemalloc:
+        tracemalloc.stop()
+    server.terminate()
+    server.join()
+    if checkpoint_dir is not None:
+        checkpoint_dir.cleanup()
+
+    delivered = len(msg_keys)
+    memory = [sample for _, sample in memory_samples if sample is not None]
+    return {
+        "generated": stats["generated"],
+        "delivered": delivered,
+        "lost": stats["generated"] - delivered,
+        "duplicates": len(latencies) - delivered,
+        "throughput": delivered / elapsed,
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "latency_p99": percentile(latencies, 0.99),
+        "latency_max": max(latencies) if latencies else float("nan"),
+        "memory_start": memory[0] if memory else None,
+        "memory_end": memory[-1] if memory else None,
+        "memory_peak": max(memory) if memory else None,
+        "memory_samples": memory_samples,
+        "requests": stats["requests"],
+        "errors": stats["errors"]
+    }
+
+def report(result: T.Dict[str, T.Any]):
+    print(f"generated   {result['generated']}")
+    print(f"delivered   {result['delivered']} (lost {result['lost']}, duplicates {result['duplicates']})")
+    print(f"throughput  {result['throughput']:.1f} msg/s")
+    print(
+        f"latency     p50 {result['latency_p50'] * 1e3:.1f} ms, p95 {result['latency_p95'] * 1e3:.1f} ms, "
+        f"p99 {result['latency_p99'] * 1e3:.1f} ms, max {result['latency_max'] * 1e3:.1f} ms"
+    )
+    if result["memory_start"] is not None:
+        mib = 1024 * 1024
+        print(
+            f"memory      start {result['memory_start'] / mib:.1f} MiB, end {result['memory_end'] / mib:.1f} MiB, "
+            f"peak {result['memory_peak'] / mib:.1f} MiB, growth {(result['memory_end'] - result['memory_start']) / mib:+.1f} MiB"
+        )
+    print("requests    " + ", ".join(f"{path.rsplit('/', 1)[-1]}={count}" for path, count in sorted(result["requests"].items())))
+    if result["errors"]:
+        print("errors      " + ", ".join(f"{path.rsplit('/', 1)[-1]}={count}" for path, count in sorted(result["errors"].items())))
+
+def main():
+    parser = argparse.ArgumentParser(description="BiliChat end-to-end benchmark against a local fake API")
+    parser.add_argument("--talkers", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--group-ratio", type=float, default=0.5)
+    parser.add_argument("--latency", type=float, default=0.02, help="injected latency per request (s)")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--sessions-per-page", type=int, default=None)
+    parser.add_argument("--warm-start", action="store_true")
+    parser.add_argument("--light-models", action="store_true")
+    parser.add_argument("--tracemalloc", action="store_true", help="measure python heap instead of RSS")
+    parser.add_argument("--restart-after", type=float, default=None, help="restart the bot from its checkpoint after this many seconds")
+    parser.add_argument("--handler-delay", type=float, default=0.0, help="seconds each handler sleeps before recording")
+    args = parser.parse_args()
+
+    profile = TrafficProfile(
+        talkers=args.talkers,
+        messages_per_second=args.rate,
+        group_ratio=args.group_ratio,
+        latency=args.latency,
+        latency_jitter=args.jitter,
+        error_rate=args.error_rate,
+        sessions_per_page=args.sessions_per_page,
+        seed=args.seed
+    )
+    report(asyncio.run(run_benchmark(
+        profile,
+        duration=args.duration,
+        use_tracemalloc=args.tracemalloc,
+        restart_after=args.restart_after,
+        handler_delay=args.handler_delay,
+        light_models=args.light_models,
+        warm_start=args.warm_start
+    )))
+
+if __name__ == "__main__":
+    main()
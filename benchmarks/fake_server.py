@@ -0,0 +1,294 @@
+# 本地模拟的 Bilibili 私信接口，按流量配置生成消息，用于端到端压测。
+import asyncio
+import json
+import random
+import time
+import typing as T
+from collections import Counter
+
+from aiohttp import web
+
+class TrafficProfile:
+    def __init__(self,
+                 talkers: int = 50,
+                 messages_per_second: float = 50,
+                 group_ratio: float = 0.5,
+                 latency: float = 0.02,
+                 latency_jitter: float = 0.01,
+                 error_rate: float = 0.0,
+                 sessions_per_page: int = None,
+                 seed: int = None):
+        self.talkers = talkers
+        self.messages_per_second = messages_per_second
+        self.group_ratio = group_ratio # 应援团会话所占比例
+        self.latency = latency # 每个请求注入的延迟（秒）
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate # 返回 HTTP 500 / -412 的概率
+        self.sessions_per_page = sessions_per_page # get_sessions 每页的会话数，None 时一次返回全部
+        self.seed = seed
+
+class _Talker:
+    __slots__ = ("talker_id", "session_type", "members", "messages", "last_ts")
+
+    def __init__(self, talker_id: int, session_type: int, members: T.List[int]):
+        self.talker_id = talker_id
+        self.session_type = session_type # 1: 私聊, 2: 应援团
+        self.members = members
+        self.messages: T.List[dict] = []
+        self.last_ts = 0 # 微秒
+
+    @property
+    def max_seqno(self) -> int:
+        return self.messages[-1]["msg_seqno"] if self.messages else 0
+
+def fake_user(uid: int) -> dict:
+    return {
+        "DisplayRank": 0,
+        "face": f"https://i0.hdslb.com/bfs/face/{uid}.jpg",
+        "level_info": {"current_exp": 0, "current_level": 3, "current_min": 0, "next_exp": 100},
+        "mid": str(uid),
+        "nameplate": {"condition": "", "image": "", "image_small": "", "level": "", "name": "", "nid": 0},
+        "official_verify": {"desc": "", "type": -1},
+        "pendant": {"expire": 0, "image": "", "image_enhance": "", "image_enhance_frame": "", "name": "", "pid": 0},
+        "rank": 10000,
+        "sex": 0,
+        "sign": "",
+        "uid": uid,
+        "uname": f"user{uid}",
+        "vip": {
+            "accessStatus": 0, "dueRemark": "", "label": {"path": ""}, "themeType": 0,
+            "vipDueDate": 0, "vipStatus": 0, "vipStatusWarn": "", "vipType": 0
+        }
+    }
+
+def fake_group(group_id: int, owner_uid: int) -> dict:
+    return {
+        "group_id": group_id,
+        "group_cover": "",
+        "group_name": f"group{group_id}",
+        "group_notice": "",
+        "owner_uid": owner_uid,
+        "fans_medal_name": ""
+    }
+
+class FakeBilibili:
+    def __init__(self, profile: TrafficProfile = None, bot_uid: int = 1):
+        self.profile = profile or TrafficProfile()
+        self.bot_uid = bot_uid
+        self.random = random.Random(self.profile.seed)
+        self.requests = Counter()
+        self.errors = Counter()
+        self.generated = 0
+        self.sent = 0
+        self.uploads = 0
+
+        self.talkers: T.Dict[int, _Talker] = {}
+        started = int(time.time() * 1000000)
+        for i in range(self.profile.talkers):
+            if self.random.random() < self.profile.group_ratio:
+                talker_id = 100000 + i
+                members = [200000 + i * 100 + j for j in range(20)]
+                self.talkers[talker_id] = _Talker(talker_id, 2, members)
+            else:
+                talker_id = 300000 + i
+                self.talkers[talker_id] = _Talker(talker_id, 1, [talker_id])
+            self.talkers[talker_id].last_ts = started - (i + 1) * 1000000 # 错开历史会话的时间，便于翻页
+        self._msg_key = 7000000000000000000
+        self._generator: T.Optional[asyncio.Task] = None
+        self._runner: T.Optional[web.AppRunner] = None
+        self.url: T.Optional[str] = None
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._inject])
+        app.router.add_get("/session_svr/v1/session_svr/get_sessions", self.get_sessions)
+        app.router.add_get("/session_svr/v1/session_svr/new_sessions", self.new_sessions)
+        app.router.add_post("/svr_sync/v1/svr_sync/update_ack", self.update_ack)
+        app.router.add_get("/svr_sync/v1/svr_sync/fetch_session_msgs", self.fetch_session_msgs)
+        app.router.add_post("/web_im/v1/web_im/send_msg", self.send_msg)
+        app.router.add_get("/account/v1/user/infos", self.user_infos)
+        app.router.add_get("/link_group/v1/group/detail", self.group_detail)
+        app.router.add_post("/x/dynamic/feed/draw/upload_bfs", self.upload_bfs)
+        app.router.add_post("/_bench/traffic/{action}", self.control)
+        app.router.add_get("/_bench/stats", self.stats)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    def start_traffic(self):
+        self._generator = asyncio.get_running_loop().create_task(self._generate())
+
+    async def stop_traffic(self):
+        if self._generator is not None:
+            self._generator.cancel()
+            await asyncio.gather(self._generator, return_exceptions=True)
+            self._generator = None
+
+    async def close(self):
+        await self.stop_traffic()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def push_message(self, talker: _Talker, content: str = None) -> dict:
+        sender_uid = self.random.choice(talker.members)
+        now = time.time()
+        self._msg_key += 1
+        message = {
+            "sender_uid": sender_uid,
+            "receiver_type": talker.session_type,
+            "receiver_id": talker.talker_id if talker.session_type == 2 else self.bot_uid,
+            "msg_type": 1,
+            "content": json.dumps({"content": content or f"bench {now:.6f}"}),
+            "msg_seqno": talker.max_seqno + 1,
+            "timestamp": int(now),
+            "at_uids": [0],
+            "msg_key": self._msg_key,
+            "msg_status": 0,
+            "notify_code": "",
+            "new_face_version": 0
+        }
+        talker.messages.append(message)
+        if len(talker.messages) > 2000: # 只保留最近的消息，避免压测进程自身无限增长
+            del talker.messages[:1000]
+        talker.last_ts = int(now * 1000000)
+        self.generated += 1
+        return message
+
+    async def _generate(self):
+        talkers = list(self.talkers.values())
+        interval = 1 / self.profile.messages_per_second
+        started, produced = time.monotonic(), 0
+        while True:
+            # 按目标速率补齐应产生的消息数，避免 sleep 误差累积
+            due = int((time.monotonic() - started) / interval) - produced
+            for _ in range(due):
+                self.push_message(self.random.choice(talkers))
+            produced += max(due, 0)
+            await asyncio.sleep(interval if interval > 0.001 else 0.001)
+
+    @web.middleware
+    async def _inject(self, request: web.Request, handler):
+        if request.path.startswith("/_bench/"): # 压测控制接口不注入延迟与错误
+            return await handler(request)
+        self.requests[request.path] += 1
+        if self.profile.latency or self.profile.latency_jitter:
+            await asyncio.sleep(max(0.0, self.profile.latency + self.random.uniform(-1, 1) * self.profile.latency_jitter))
+        if self.profile.error_rate and self.random.random() < self.profile.error_rate:
+            self.errors[request.path] += 1
+            if self.random.random() < 0.5:
+                raise web.HTTPInternalServerError()
+            return web.json_response({"code": -412, "message": "请求被拦截", "data": None})
+        return await handler(request)
+
+    async def control(self, request: web.Request):
+        if request.match_info["action"] == "start":
+            self.start_traffic()
+        else:
+            await self.stop_traffic()
+        return web.json_response(self._stats())
+
+    async def stats(self, request: web.Request):
+        return web.json_response(self._stats())
+
+    def _stats(self) -> dict:
+        return {
+            "generated": self.generated,
+            "sent": self.sent,
+            "uploads": self.uploads,
+            "requests": dict(self.requests),
+            "errors": dict(self.errors)
+        }
+
+    @staticmethod
+    def _session(talker: _Talker) -> dict:
+        return {
+            "talker_id": talker.talker_id,
+            "session_type": talker.session_type,
+            "max_seqno": talker.max_seqno,
+            "session_ts": talker.last_ts
+        }
+
+    async def get_sessions(self, request: web.Request):
+        sessions = sorted(self.talkers.values(), key=lambda talker: talker.last_ts, reverse=True)
+        if "end_ts" in request.query:
+            end_ts = int(request.query["end_ts"])
+            sessions = [talker for talker in sessions if talker.last_ts < end_ts]
+        page_size = self.profile.sessions_per_page or len(sessions)
+        return web.json_response({"code": 0, "data": {
+            "session_list": [self._session(talker) for talker in sessions[:page_size]],
+            "has_more": int(len(sessions) > page_size)
+        }})
+
+    async def new_sessions(self, request: web.Request):
+        begin_ts = int(request.query.get("begin_ts", 0))
+        sessions = [self._session(talker) for talker in self.talkers.values() if talker.last_ts > begin_ts]
+        return web.json_response({"code": 0, "data": {"session_list": sessions or None}})
+
+    async def update_ack(self, request: web.Request):
+        return web.json_response({"code": 0, "data": None})
+
+    async def fetch_session_msgs(self, request: web.Request):
+        talker = self.talkers.get(int(request.query["talker_id"]))
+        if talker is None:
+            return web.json_response({"code": 0, "data": {"messages": None, "has_more": 0}})
+        begin_seqno = int(request.query.get("begin_seqno", 0))
+        size = int(request.query.get("size", 20))
+        pending = [message for message in talker.messages if message["msg_seqno"] > begin_seqno]
+        page = pending[:size]
+        return web.json_response({"code": 0, "data": {
+            "messages": list(reversed(page)) or None, # 与线上接口一致，新消息在前
+            "has_more": int(len(pending) > size),
+            "min_seqno": page[0]["msg_seqno"] if page else 0,
+            "max_seqno": page[-1]["msg_seqno"] if page else 0
+        }})
+
+    async def send_msg(self, request: web.Request):
+        data = await request.post()
+        self.sent += 1
+        self._msg_key += 1
+        return web.json_response({"code": 0, "data": {
+            "msg_key": self._msg_key,
+            "msg_content": data.get("msg[content]", "")
+        }})
+
+    async def user_infos(self, request: web.Request):
+        uids = [int(uid) for uid in request.query.get("uids", "").split(",") if uid]
+        return web.json_response({"code": 0, "data": [fake_user(uid) for uid in uids]})
+
+    async def group_detail(self, request: web.Request):
+        group_id = int(request.query["group_id"])
+        talker = self.talkers.get(group_id)
+        owner_uid = talker.members[0] if talker else 0
+        return web.json_response({"code": 0, "data": fake_group(group_id, owner_uid)})
+
+    async def upload_bfs(self, request: web.Request):
+        await request.read()
+        self.uploads += 1
+        return web.json_response({"code": 0, "data": {
+            "image_url": f"https://i0.hdslb.com/bfs/im/{self.uploads}.png",
+            "image_width": 100,
+            "image_height": 100
+        }})
+
+def serve_forever(profile: TrafficProfile, host: str = "127.0.0.1", port: int = 0, ready=None):
+    # 在独立进程中运行，ready 为 multiprocessing 队列，用于回传地址
+    async def main():
+        server = FakeBilibili(profile)
+        url = await server.start(host, port)
+        if ready is not None:
+            ready.put(url)
+        else:
+            print(f"fake bilibili api listening on {url}")
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+if __name__ == "__main__":
+    serve_forever(TrafficProfile(), port=8080)
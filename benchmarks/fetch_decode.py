@@ -0,0 +1,62 @@
+# 比较 network.fetch 每个请求的 CPU 开销：
+# 旧实现先解码为 str 再 json.loads，且总是构造包含完整响应体的调试日志；
+# 新实现直接从 bytes 解码（安装 orjson 时使用 orjson），调试日志仅在 DEBUG 时格式化。
+#
+#   python -m bilichat.benchmarks.fetch_decode
+import json
+import time
+import timeit
+
+from ..logger import Network, is_debug_enabled
+from ..network import fetch, json_loads
+
+def sample_body(count: int = 20) -> bytes:
+    return json.dumps({
+        "code": 0,
+        "msg": "0",
+        "message": "0",
+        "data": {
+            "messages": [{
+                "sender_uid": 10000 + i,
+                "receiver_type": 2,
+                "receiver_id": 4000,
+                "msg_type": 1,
+                "content": json.dumps({"content": f"第 {i} 条测试消息 " * 4}, ensure_ascii=False),
+                "msg_seqno": 1000 + i,
+                "timestamp": int(time.time()),
+                "at_uids": [0],
+                "msg_key": 7000000000000000000 + i,
+                "msg_status": 0,
+                "notify_code": "",
+                "new_face_version": 0
+            } for i in range(count)],
+            "has_more": 0,
+            "min_seqno": 1000,
+            "max_seqno": 1000 + count
+        }
+    }, ensure_ascii=False).encode("utf-8")
+
+def before(url, params, body: bytes):
+    data = body.decode("utf-8")
+    message = f"requested url={url}, by params={params}, and status=200, data={data}" # 旧实现总会构造该字符串
+    return json.loads(data), message
+
+def after(url, params, body: bytes, client: fetch):
+    if is_debug_enabled():
+        Network.debug(f"requested url={url}, by params={params}, and status=200, data={body.decode('utf-8', 'replace')}")
+    return client.decode(url, params, body)
+
+def main(number: int = 20000):
+    client = fetch()
+    url = "https://api.vc.bilibili.com/svr_sync/v1/svr_sync/fetch_session_msgs"
+    params = {"talker_id": 4000, "session_type": 2, "size": 20, "begin_seqno": 1000}
+    print(f"json backend: {json_loads.__module__}, debug logging: {is_debug_enabled()}")
+    for count in (1, 20, 100):
+        body = sample_body(count)
+        assert before(url, params, body)[0] == after(url, params, body, client)
+        old = min(timeit.repeat(lambda: before(url, params, body), number=number, repeat=3)) / number
+        new = min(timeit.repeat(lambda: after(url, params, body, client), number=number, repeat=3)) / number
+        print(f"{count:>4} messages, {len(body):>7} bytes: before {old * 1e6:8.2f} us, after {new * 1e6:8.2f} us, x{old / new:.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# 比较 pydantic 模型与 light_models=True 时使用的轻量模型的构造开销：
+# 只读取 sender_uid 的处理器不会触发 content 的 json 解码。
+#
+#   python -m bilichat.benchmarks.models
+import json
+import time
+import timeit
+
+from ..event.models import Message, MessageRecall, LightMessage, LightMessageRecall
+
+def sample_messages(count: int = 20):
+    return [{
+        "sender_uid": 10000 + i,
+        "receiver_type": 2,
+        "receiver_id": 4000,
+        "msg_type": 5 if i % 10 == 9 else 1,
+        "content": str(7000000000000000000 + i - 1) if i % 10 == 9 else \
+            json.dumps({"content": f"第 {i} 条测试消息 " * 4}, ensure_ascii=False),
+        "msg_seqno": 1000 + i,
+        "timestamp": int(time.time()),
+        "at_uids": [0],
+        "msg_key": 7000000000000000000 + i,
+        "msg_status": 0,
+        "notify_code": "",
+        "new_face_version": 0
+    } for i in range(count)]
+
+def parse(messages, models, read_content: bool):
+    for _message in messages:
+        message = models[_message["msg_type"]].parse_obj(_message)
+        message.sender_uid
+        if read_content:
+            message.content
+
+def main(number: int = 2000):
+    messages = sample_messages()
+    pydantic_models = {1: Message, 2: Message, 5: MessageRecall}
+    light_models = {1: LightMessage, 2: LightMessage, 5: LightMessageRecall}
+    for read_content in (False, True):
+        old = min(timeit.repeat(lambda: parse(messages, pydantic_models, read_content), number=number, repeat=3))
+        new = min(timeit.repeat(lambda: parse(messages, light_models, read_content), number=number, repeat=3))
+        per_message = number * len(messages)
+        print(
+            f"read content={read_content!s:<5}: pydantic {old / per_message * 1e6:6.2f} us/msg, "
+            f"light {new / per_message * 1e6:6.2f} us/msg, x{old / new:.2f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import asyncio
+import hashlib
+import json
+import time
+import typing as T
+from collections import OrderedDict
+from pathlib import Path
+
+from .logger import Protocol
+
+_MISSING = object()
+
+class EntityCache:
+    def __init__(self,
+                 maxsize: int = 10000,
+                 ttl: float = 6 * 3600,
+                 loader: T.Callable[[T.Hashable], T.Awaitable[T.Any]] = None,
+                 stale_while_revalidate: bool = True):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.loader = loader
+        self.stale_while_revalidate = stale_while_revalidate
+
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.refreshes = 0
+
+        self._entries: "OrderedDict[T.Hashable, T.Tuple[T.Any, float]]" = OrderedDict() # key -> (value, expires_at)
+        self._refreshing: T.Dict[T.Hashable, asyncio.Task] = {}
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def set(self, key, value, ttl: float = None):
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._entries.clear()
+
+    def items(self):
+        return [(key, value) for key, (value, _) in self._entries.items()]
+
+    def snapshot(self, encode: T.Callable[[T.Any], T.Any]) -> list:
+        # 以墙上时间记录过期时刻，便于跨进程恢复
+        offset = time.time() - time.monotonic()
+        return [
+            [key, encode(value), expires_at + offset]
+            for key, (value, expires_at) in self._entries.items() if value is not None
+        ]
+
+    def restore(self, entries: list, decode: T.Callable[[T.Any], T.Any]) -> int:
+        # 已过期的条目仍会载入，首次访问时按 stale_while_revalidate 后台刷新
+        now = time.time()
+        restored = 0
+        for key, value, expires_at in entries:
+            if key not in self._entries:
+                self.set(key, decode(value), ttl=expires_at - now)
+                restored += 1
+        return restored
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            self.stale_hits += 1
+            self._schedule_refresh(key)
+        else:
+            self.hits += 1
+        return value
+
+    async def fetch(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return value
+            if self.stale_while_revalidate: # 先返回旧值，后台刷新
+                self.stale_hits += 1
+                self._entries.move_to_end(key)
+                self._schedule_refresh(key)
+                return value
+        self.misses += 1
+        if self.loader is None:
+            raise KeyError(key)
+        value = await self.loader(key)
+        self.set(key, value)
+        return value
+
+    def _schedule_refresh(self, key):
+        if self.loader is None or key in self._refreshing:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._refreshing[key] = loop.create_task(self._refresh(key))
+
+    async def _refresh(self, key):
+        try:
+            self.set(key, await self.loader(key))
+            self.refreshes += 1
+        except Exception as e: # 刷新失败时继续使用旧值
+            Protocol.warning(f"refreshing cached entity {key} failed: {e.__class__.__name__}")
+        finally:
+            self._refreshing.pop(key, None)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.stale_hits + self.misses
+        return (self.hits + self.stale_hits) / total if total else 0.0
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "refreshes": self.refreshes,
+            "hit_rate": self.hit_rate
+        }
+
+class DependencyCache:
+    def __init__(self, maxsize: int = None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[T.Hashable, T.Tuple[asyncio.Future, T.Optional[float]]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def resolve(self, key, factory: T.Callable[[], T.Awaitable], ttl: float = None):
+        entry = self._entries.get(key)
+        if entry is not None:
+            future, expires_at = entry
+            failed = future.done() and (future.cancelled() or future.exception() is not None)
+            if not failed and (expires_at is None or expires_at > time.monotonic()):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return await asyncio.shield(future) # 同一依赖的并发调用共享同一次执行
+        self.misses += 1
+        future = asyncio.ensure_future(factory())
+        self._entries[key] = (future, time.monotonic() + ttl if ttl is not None else None)
+        self._entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return await asyncio.shield(future)
+
+    def clear(self):
+        self._entries.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
+
+class ImageCache:
+    def __init__(self, maxsize: int = 1024, path: T.Union[str, Path] = None):
+        self.maxsize = maxsize
+        self.path = Path(path) if path is not None else None
+        self.hits = 0
+        self.misses = 0
+
+        self._entries: "OrderedDict[str, dict]" = OrderedDict() # sha256 -> 上传结果
+        self._uploading: T.Dict[str, asyncio.Future] = {}
+        self._saving: T.Optional[asyncio.Task] = None # 唯一的写入任务，写入期间的新上传合并到下一次写入
+        self._dirty = False
+        if self.path is not None and self.path.exists():
+            try:
+                self._entries.update(json.loads(self.path.read_text(encoding="utf-8")))
+            except (OSError, ValueError) as e:
+                Protocol.warning(f"loading image cache {self.path} failed: {e.__class__.__name__}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def digest(image: T.Union[bytes, bytearray, memoryview]) -> str:
+        return hashlib.sha256(image).hexdigest()
+
+    async def get_or_upload(self, digest: str, upload: T.Callable[[], T.Awaitable[dict]]) -> dict:
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(digest)
+            return entry
+        future = self._uploading.get(digest)
+        if future is not None: # 同一图片正在上传
+            self.hits += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = self._uploading[digest] = asyncio.ensure_future(upload())
+        try:
+            entry = await asyncio.shield(future)
+        finally:
+            self._uploading.pop(digest, None)
+        self._entries[digest] = entry
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        if self.path is not None: # 持久化在后台进行，失败不影响本次上传的结果
+            self._dirty = True
+            if self._saving is None:
+                self._saving = asyncio.get_running_loop().create_task(self._save_pending())
+        return entry
+
+    async def _save_pending(self):
+        try:
+            while self._dirty:
+                self._dirty = False
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.save, dict(self._entries))
+                except OSError as e:
+                    Protocol.warning(f"saving image cache {self.path} failed: {e.__class__.__name__}")
+        finally:
+            self._saving = None
+
+    async def flush(self):
+        if self._saving is not None:
+            await asyncio.shield(self._saving)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate
+        }
+
+    def save(self, entries: T.Dict[str, dict] = None):
+        if self.path is None:
+            return
+        temp = self.path.with_suffix(self.path.suffix + ".tmp")
+        temp.write_text(json.dumps(entries if entries is not None else dict(self._entries)), encoding="utf-8")
+        temp.replace(self.path)
@@ -0,0 +1,180 @@
+import asyncio
+import sqlite3
+import typing as T
+from collections import OrderedDict
+from pathlib import Path
+
+from .logger import Protocol
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS acks (account TEXT, talker_id INTEGER, seqno INTEGER, PRIMARY KEY (account, talker_id)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS state (account TEXT PRIMARY KEY, session_ts INTEGER)",
+    "CREATE TABLE IF NOT EXISTS seen (account TEXT, msg_key INTEGER, PRIMARY KEY (account, msg_key)) WITHOUT ROWID"
+)
+
+class Checkpoint:
+    def __init__(self,
+                 path: T.Union[str, Path],
+                 interval: float = 5.0,
+                 dedup_size: int = 10000):
+        self.path = Path(path)
+        self.interval = interval # 两次写入之间的间隔（秒）
+        self.dedup_size = dedup_size # 持久化的最近 msg_key 数量，用于重启后去重
+        self.account: T.Optional[str] = None
+
+        self.acks: T.Dict[int, int] = {} # talker_id -> 已处理完的 seqno（其下的消息均已执行完处理器）
+        self.session_ts = 0
+        self.flushes = 0
+        self.duplicates = 0
+
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        self._read: T.Dict[int, int] = {} # talker_id -> 已读取并入队的 seqno
+        self._inflight: T.Dict[int, T.Set[int]] = {} # talker_id -> 已入队但处理器未执行完的 seqno
+        self._dirty_acks: T.Set[int] = set()
+        self._new_keys: T.List[int] = []
+        self._expired_keys: T.List[int] = []
+        self._dirty_state = False
+        self._lock: T.Optional[asyncio.Lock] = None
+        self._task: T.Optional[asyncio.Task] = None
+        self._connection: T.Optional[sqlite3.Connection] = None
+
+    def connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.path), check_same_thread=False) # 只在执行器中串行使用
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                self._connection.execute(statement)
+        return self._connection
+
+    def load(self, account: str) -> bool:
+        connection = self.connect()
+        self.account = account
+        self.acks = dict(connection.execute("SELECT talker_id, seqno FROM acks WHERE account = ?", (account,)))
+        row = connection.execute("SELECT session_ts FROM state WHERE account = ?", (account,)).fetchone()
+        self.session_ts = row[0] if row else 0
+        self._seen = OrderedDict.fromkeys(
+            key for key, in connection.execute("SELECT msg_key FROM seen WHERE account = ? ORDER BY msg_key", (account,))
+        )
+        return row is not None
+
+    async def restore(self, account: str) -> bool:
+        self._lock = asyncio.Lock()
+        try:
+            restored = await asyncio.get_running_loop().run_in_executor(None, self.load, account)
+        except sqlite3.Error as e:
+            Protocol.warning(f"loading checkpoint {self.path} failed: {e.__class__.__name__}: {e}")
+            self.account = account
+            return False
+        if restored:
+            Protocol.info(f"restored checkpoint of {len(self.acks)} sessions from {self.path}")
+        return restored
+
+    def mark(self, talker_id: int, seqno: int):
+        # 会话已读取到 seqno；只有其下的消息全部处理完才会写入 acks
+        if seqno > self._read.get(talker_id, -1):
+            self._read[talker_id] = seqno
+        self._commit(talker_id)
+
+    def begin(self, talker_id: int, seqno: int):
+        self._inflight.setdefault(talker_id, set()).add(seqno)
+
+    def complete(self, talker_id: int, seqno: int, msg_key: int):
+        # 消息的所有处理器执行完毕；重复调用无效
+        inflight = self._inflight.get(talker_id)
+        if not inflight or seqno not in inflight:
+            return
+        inflight.discard(seqno)
+        if not inflight:
+            del self._inflight[talker_id]
+        self._remember(msg_key)
+        self._commit(talker_id)
+
+    def _commit(self, talker_id: int):
+        seqno = self._read.get(talker_id)
+        if seqno is None:
+            return
+        inflight = self._inflight.get(talker_id)
+        if inflight: # 最早一条未处理完的消息之前的部分
+            seqno = min(seqno, min(inflight) - 1)
+        if seqno > self.acks.get(talker_id, -1):
+            self.acks[talker_id] = seqno
+            self._dirty_acks.add(talker_id)
+
+    def set_session_ts(self, session_ts: int):
+        if session_ts > self.session_ts:
+            self.session_ts = session_ts
+            self._dirty_state = True
+
+    def seen(self, msg_key: int) -> bool:
+        # 重启前已处理完的消息返回 True
+        if msg_key in self._seen:
+            self.duplicates += 1
+            return True
+        return False
+
+    def _remember(self, msg_key: int):
+        if msg_key in self._seen:
+            return
+        self._seen[msg_key] = None
+        self._new_keys.append(msg_key)
+        while len(self._seen) > self.dedup_size:
+            self._expired_keys.append(self._seen.popitem(last=False)[0])
+
+    def start(self):
+        if self._task is None and self.interval:
+            self._task = asyncio.get_running_loop().create_task(self._flush_periodically())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def flush(self):
+        if self.account is None or not (self._dirty_acks or self._dirty_state or self._new_keys or self._expired_keys):
+            return
+        # 在事件循环中取出待写入的内容，写入在执行器中完成
+        acks = [(self.account, talker_id, self.acks[talker_id]) for talker_id in self._dirty_acks]
+        state = (self.account, self.session_ts) if self._dirty_state else None
+        new_keys = [(self.account, key) for key in self._new_keys]
+        expired_keys = [(self.account, key) for key in self._expired_keys]
+        self._dirty_acks, self._dirty_state, self._new_keys, self._expired_keys = set(), False, [], []
+        async with self._lock:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.write, acks, state, new_keys, expired_keys)
+                self.flushes += 1
+            except sqlite3.Error as e:
+                Protocol.warning(f"writing checkpoint {self.path} failed: {e.__class__.__name__}: {e}")
+                # 留待下次重试
+                self._dirty_acks.update(talker_id for _, talker_id, _ in acks)
+                self._dirty_state = self._dirty_state or state is not None
+                self._new_keys[:0] = [key for _, key in new_keys]
+                self._expired_keys[:0] = [key for _, key in expired_keys]
+
+    def write(self, acks, state, new_keys, expired_keys):
+        connection = self.connect()
+        with connection: # 单个事务
+            connection.executemany("INSERT OR REPLACE INTO acks VALUES (?, ?, ?)", acks)
+            if state is not None:
+                connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", state)
+            connection.executemany("INSERT OR IGNORE INTO seen VALUES (?, ?)", new_keys)
+            connection.executemany("DELETE FROM seen WHERE account = ? AND msg_key = ?", expired_keys)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "sessions": len(self.acks),
+            "seen": len(self._seen),
+            "inflight": sum(len(inflight) for inflight in self._inflight.values()),
+            "flushes": self.flushes,
+            "duplicates": self.duplicates
+        }
@@ -1,4 +1,4 @@
 from collections import namedtuple
 from pydantic import BaseModel
 
-InternalEvent = namedtuple("Event", ("name", "body"))
\ No newline at end of file
+InternalEvent = namedtuple("Event", ("name", "body", "created", "done"), defaults=(None, None)) # created: time.monotonic(), done: 所有处理器执行完后调用
\ No newline at end of file
@@ -1,16 +1,42 @@
+from collections import namedtuple
 from pydantic import BaseModel
 import typing as T
 
+from ..offload import OFFLOAD_NONE, OFFLOAD_THREAD, OFFLOAD_PROCESS
+
+PARAM_ANNOTATION = "annotation"
+PARAM_DEPEND = "depend"
+PARAM_EXTRA = "extra"
+
+SCOPE_EVENT = "event" # 同一事件的所有处理器共享
+SCOPE_SESSION = "session" # 同一会话 (talker) 共享，可设置 ttl
+SCOPE_GLOBAL = "global" # 全局共享，可设置 ttl
+
+# parameters: ((name, kind, source), ...)，kind 为上面的 PARAM_* 之一
+# cache: None 或 (scope, ttl)
+# offload: None 或 OFFLOAD_THREAD / OFFLOAD_PROCESS，callable 在对应的池中执行
+CallPlan = namedtuple("CallPlan", ("callable", "dependencies", "parameters", "middlewares", "cache", "offload"), defaults=(None, None))
+
 class Depend:
-    def __init__(self, func, middlewares=[], cache=True):
+    def __init__(self, func, middlewares=[], cache=True, scope=SCOPE_EVENT, ttl=None, offload=OFFLOAD_NONE):
+        if scope not in (SCOPE_EVENT, SCOPE_SESSION, SCOPE_GLOBAL):
+            raise ValueError(f"unknown dependency cache scope: {scope}")
+        if offload not in (OFFLOAD_NONE, OFFLOAD_THREAD, OFFLOAD_PROCESS):
+            raise ValueError(f"unknown offload mode: {offload}")
         self.func = func
         self.middlewares = middlewares
         self.cache = cache
+        self.scope = scope
+        self.ttl = ttl
+        self.offload = offload
 
 class ExecutorProtocol(BaseModel):
     callable: T.Callable
     dependencies: T.List[Depend]
     middlewares: T.List
+    offload: T.Optional[str] = None
+    route: T.Optional[T.Any] = None
+    plan: T.Optional[T.Any] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -54,4 +54,107 @@ class Emoji(BaseModel):
     gif_url: T.Optional[str]
     size: int
     text: str
-    url: str
\ No newline at end of file
+    url: str
+_UNDECODED = object()
+
+class LightModel:
+    # 无校验的轻量模型，属性名与对应的 pydantic 模型一致
+    __slots__ = ()
+    __event_name__: str = None
+    __fields__: T.Tuple[str, ...] = ()
+
+    @classmethod
+    def parse_obj(cls, obj: dict):
+        return cls(**obj)
+
+    def dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__fields__}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.dict() == other.dict()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({', '.join(f'{k}={v!r}' for k, v in self.dict().items())})"
+
+    def __getstate__(self): # 支持 pickle，以便提交到进程池
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+class LightMessage(LightModel):
+    __slots__ = (
+        "at_uids", "_content", "_raw_content", "msg_key", "msg_seqno", "msg_status", "msg_type",
+        "new_face_version", "notify_code", "receiver_id", "receiver_type", "sender_uid", "timestamp"
+    )
+    __event_name__ = "Message"
+    __fields__ = (
+        "type", "at_uids", "content", "msg_key", "msg_seqno", "msg_status", "msg_type",
+        "new_face_version", "notify_code", "receiver_id", "receiver_type", "sender_uid", "timestamp"
+    )
+    type = "Message"
+
+    def __init__(self, content: str, at_uids: list = None, msg_key: int = 0, msg_seqno: int = 0,
+                 msg_status: int = 0, msg_type: int = 0, new_face_version: int = None, notify_code: str = "",
+                 receiver_id: int = 0, receiver_type: int = 0, sender_uid: int = 0, timestamp: int = 0, **_):
+        self._raw_content = content
+        self._content = _UNDECODED
+        self.at_uids = at_uids
+        self.msg_key = msg_key
+        self.msg_seqno = msg_seqno
+        self.msg_status = msg_status
+        self.msg_type = msg_type
+        self.new_face_version = new_face_version
+        self.notify_code = notify_code
+        self.receiver_id = receiver_id
+        self.receiver_type = receiver_type
+        self.sender_uid = sender_uid
+        self.timestamp = timestamp
+
+    @property
+    def content(self) -> T.Union[str, dict]:
+        if self._content is _UNDECODED: # 首次访问时才解码
+            self._content = json.loads(self._raw_content)
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        if state["_content"] is _UNDECODED: # 未解码时只传递原始字符串
+            del state["_content"]
+        return state
+
+    def __setstate__(self, state):
+        self._content = _UNDECODED
+        super().__setstate__(state)
+
+class LightMessageRecall(LightModel):
+    __slots__ = (
+        "at_uids", "content", "msg_key", "msg_seqno", "msg_status", "msg_type",
+        "new_face_version", "notify_code", "receiver_id", "receiver_type", "sender_uid", "timestamp"
+    )
+    __event_name__ = "MessageRecall"
+    __fields__ = ("type",) + __slots__
+    type = "MessageRecall"
+
+    def __init__(self, content: str, at_uids: list = None, msg_key: int = 0, msg_seqno: int = 0,
+                 msg_status: int = 0, msg_type: int = 0, new_face_version: int = None, notify_code: str = "",
+                 receiver_id: int = 0, receiver_type: int = 0, sender_uid: int = 0, timestamp: int = 0, **_):
+        self.content = content
+        self.at_uids = at_uids
+        self.msg_key = msg_key
+        self.msg_seqno = msg_seqno
+        self.msg_status = msg_status
+        self.msg_type = msg_type
+        self.new_face_version = new_face_version
+        self.notify_code = notify_code
+        self.receiver_id = receiver_id
+        self.receiver_type = receiver_type
+        self.sender_uid = sender_uid
+        self.timestamp = timestamp
@@ -0,0 +1,126 @@
+import asyncio
+import traceback
+import typing as T
+
+from .application import BiliChat
+from .cache import EntityCache
+from .network import fetch
+from .metrics import Metrics
+from .replay import Recorder
+from .logger import Network
+from .logger import Session as SessionLogger
+
+class BiliChatHost:
+    def __init__(self,
+                 network: fetch = None,
+                 user_cache: EntityCache = None,
+                 group_cache: EntityCache = None,
+                 stagger: float = 2.0,
+                 metrics: Metrics = None,
+                 recorder: Recorder = None):
+        self.network = network or fetch()
+        # 共享连接池的请求耗时与录制属于 host，而不是恰好第一个创建的账号
+        self.metrics = metrics or Metrics()
+        if self.network.metrics is None:
+            self.network.metrics = self.metrics
+        self.recorder = recorder
+        if recorder is not None and self.network.recorder is None:
+            self.network.recorder = recorder
+        self.user_cache = user_cache if user_cache is not None else EntityCache()
+        self.group_cache = group_cache if group_cache is not None else EntityCache()
+        # 共享缓存的加载由 host 负责，经当前任一在线账号请求，不依赖某个账号的生命周期
+        if self.user_cache.loader is None:
+            self.user_cache.loader = self.load_user
+        if self.group_cache.loader is None:
+            self.group_cache.loader = self.load_group
+        self.stagger = stagger # 在该时间窗口内均匀错开各账号的首次轮询
+        self.bots: T.List[BiliChat] = []
+        self._started = False
+        self._starting: T.Set[asyncio.Task] = set()
+        self._live: T.List[BiliChat] = [] # 已启动的账号，共享实体经其中之一加载
+
+    def add(self, cookies: str, **options) -> BiliChat:
+        options.setdefault("network", self.network)
+        options.setdefault("user_cache", self.user_cache)
+        options.setdefault("group_cache", self.group_cache)
+        return self.add_bot(BiliChat(cookies, **options))
+
+    def add_bot(self, bot: BiliChat) -> BiliChat:
+        self.bots.append(bot)
+        if self._started:
+            # 启动后加入的账号按黄金分割依次落在错开窗口内，不与已有账号同时轮询
+            bot.poll_scheduler.offset = self.stagger * ((len(self.bots) - 1) * 0.6180339887 % 1)
+            task = asyncio.get_running_loop().create_task(self._start_bot(bot))
+            self._starting.add(task)
+            task.add_done_callback(self._starting.discard)
+        return bot
+
+    async def _load(self, load: T.Callable[[BiliChat], T.Awaitable]):
+        # 优先使用同一个账号，使其 user_loader 能合并请求；失败（如 cookies 失效、被拦截）时换下一个账号
+        error = None
+        for bot in list(self._live):
+            try:
+                return await load(bot)
+            except Exception as e:
+                error = e
+                Network.warning(f"loading shared entity through {bot.cookies['DedeUserID']} failed: {e.__class__.__name__}")
+                if bot in self._live and len(self._live) > 1:
+                    self._live.remove(bot)
+                    self._live.append(bot)
+        if error is not None:
+            raise error
+        raise RuntimeError("no started bot available to load shared entities")
+
+    async def load_user(self, user_id: int):
+        return await self._load(lambda bot: bot.getUserDetail(user_id))
+
+    async def load_group(self, group_id: int):
+        return await self._load(lambda bot: bot.getGroupDetail(group_id))
+
+    async def remove_bot(self, bot: BiliChat):
+        self.bots.remove(bot)
+        await self._close_bot(bot)
+
+    async def start(self):
+        self._started = True
+        count = len(self.bots)
+        for index, bot in enumerate(self.bots):
+            bot.poll_scheduler.offset = self.stagger * index / count if count else 0
+        await self.metrics.start()
+        await asyncio.gather(*[self._start_bot(bot) for bot in self.bots])
+
+    async def close(self):
+        if self._starting:
+            await asyncio.gather(*self._starting, return_exceptions=True)
+        await asyncio.gather(*[self._close_bot(bot) for bot in self.bots], return_exceptions=True)
+        self._started = False
+        if self.recorder is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.recorder.close)
+        await self.metrics.close()
+        await self.network.close()
+
+    async def _start_bot(self, bot: BiliChat):
+        await bot.start()
+        if bot in self.bots:
+            self._live.append(bot)
+        await bot.run_lifecycle("start", "around")
+
+    async def _close_bot(self, bot: BiliChat):
+        if bot in self._live:
+            self._live.remove(bot)
+        try:
+            await bot.run_lifecycle("around", "end")
+        finally:
+            await bot.close(close_network=bot.network is not self.network)
+
+    def run(self):
+        loop = asyncio.get_event_loop()
+        try:
+            loop.run_until_complete(self.start())
+            loop.run_forever()
+        except KeyboardInterrupt:
+            SessionLogger.info("catched Ctrl-C, exiting..")
+        except Exception as e:
+            traceback.print_exc()
+        finally:
+            loop.run_until_complete(self.close())
@@ -0,0 +1,66 @@
+import asyncio
+import typing as T
+
+class BatchLoader:
+    def __init__(self,
+                 batch_func: T.Callable[[T.List[T.Hashable]], T.Awaitable[T.Dict[T.Hashable, T.Any]]],
+                 window: float = 0.05,
+                 max_batch: int = 50):
+        self.batch_func = batch_func
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requested = 0
+        self.coalesced = 0
+
+        self._futures: T.Dict[T.Hashable, asyncio.Future] = {} # 排队中与请求中的 key
+        self._queued: T.List[T.Hashable] = []
+        self._timer: T.Optional[asyncio.TimerHandle] = None
+        self._dispatching: T.Set[asyncio.Task] = set() # 保留引用，避免请求中的任务被回收
+
+    async def load(self, key):
+        self.requested += 1
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            self._queued.append(key)
+            if len(self._queued) >= self.max_batch:
+                self.flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self.flush)
+        else: # 同一个 key 共享正在进行的请求
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: T.Iterable[T.Hashable]) -> T.List[T.Any]:
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._queued:
+            return
+        keys, self._queued = self._queued, []
+        self.batches += 1
+        task = asyncio.get_running_loop().create_task(self._dispatch(keys))
+        self._dispatching.add(task)
+        task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, keys: T.List[T.Hashable]):
+        try:
+            results = await self.batch_func(keys)
+        except Exception as e:
+            results, error = {}, e
+        else:
+            error = None
+        for key in keys:
+            future = self._futures.pop(key)
+            if future.done():
+                continue
+            if error is None: # 响应中缺少的 key（如已注销的账号）解析为 None
+                future.set_result(results.get(key))
+            else:
+                future.set_exception(error)
+                future.exception() # 调用方可能已取消，避免 "exception was never retrieved"
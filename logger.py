@@ -4,15 +4,99 @@ from logbook import (
     INFO,
     DEBUG
 )
+from logbook.queues import ThreadedWrapperHandler, TWHThreadController
+import atexit
 import os
+import queue
+import random
 import sys
 
+POLICY_DROP = "drop" # 缓冲区已满时丢弃新日志
+POLICY_BLOCK = "block" # 缓冲区已满时等待写入线程
+
+class AsyncHandler(ThreadedWrapperHandler):
+    # 记录在调用处 O(1) 入队，由后台线程格式化并写出
+    _direct_attrs = ThreadedWrapperHandler._direct_attrs | frozenset(["policy", "dropped"])
+
+    def __init__(self, handler, maxsize: int = 10000, policy: str = POLICY_DROP):
+        if policy not in (POLICY_DROP, POLICY_BLOCK):
+            raise ValueError(f"unknown log buffer policy: {policy}")
+        ThreadedWrapperHandler.__init__(self, handler, maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    def emit(self, record):
+        item = (TWHThreadController.Command.emit, record)
+        if self.policy == POLICY_BLOCK:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.controller.running: # 写完缓冲区中剩余的日志
+            self.queue.put((TWHThreadController.Command.stop,))
+            self.controller._thread.join()
+            self.controller.running = False
+        self.handler.flush()
+
 logbook.set_datetime_format('local')
 stream_handler = StreamHandler(sys.stdout, level=INFO if not os.environ.get("BILICHAT_DEBUG") else DEBUG)
 stream_handler.format_string = '[{record.time:%Y-%m-%d %H:%M:%S}][BiliChat][{record.channel}] {record.message}'
-stream_handler.push_application()
+active_handler = stream_handler
+active_handler.push_application()
+
+event_sample_rate = 1.0 # 每条消息的 Event 日志的采样比例
+events_sampled_out = 0
 
 Event = Logger('Event', level=INFO)
 Network = Logger("Network", level=DEBUG)
 Session = Logger("Session", level=INFO)
-Protocol = Logger("Protocol", level=INFO)
\ No newline at end of file
+Protocol = Logger("Protocol", level=INFO)
+
+def is_debug_enabled() -> bool:
+    return stream_handler.level <= DEBUG
+
+def configure(async_mode: bool = None, buffer: int = None, policy: str = None, event_sample: float = None):
+    global active_handler, event_sample_rate
+    if event_sample is not None:
+        event_sample_rate = event_sample
+    if async_mode is None:
+        return
+    active_handler.pop_application()
+    if isinstance(active_handler, AsyncHandler):
+        active_handler.close()
+    if async_mode:
+        active_handler = AsyncHandler(stream_handler, buffer or 10000, policy or POLICY_DROP)
+    else:
+        active_handler = stream_handler
+    active_handler.push_application()
+
+def sample_event() -> bool:
+    global events_sampled_out
+    if event_sample_rate >= 1 or random.random() < event_sample_rate:
+        return True
+    events_sampled_out += 1
+    return False
+
+def stats() -> dict:
+    return {
+        "async": int(isinstance(active_handler, AsyncHandler)),
+        "queued": active_handler.queue.qsize() if isinstance(active_handler, AsyncHandler) else 0,
+        "dropped": active_handler.dropped if isinstance(active_handler, AsyncHandler) else 0,
+        "sampled_out": events_sampled_out
+    }
+
+@atexit.register
+def _flush():
+    if isinstance(active_handler, AsyncHandler):
+        active_handler.close()
+
+configure(
+    async_mode=os.environ.get("BILICHAT_LOG_ASYNC", "0") not in ("", "0") or None,
+    buffer=int(os.environ.get("BILICHAT_LOG_BUFFER", 10000)),
+    policy=os.environ.get("BILICHAT_LOG_POLICY", POLICY_DROP),
+    event_sample=float(os.environ.get("BILICHAT_EVENT_LOG_SAMPLE", 1.0))
+)
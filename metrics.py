@@ -0,0 +1,199 @@
+import asyncio
+import time
+import typing as T
+from bisect import bisect_left
+
+from aiohttp import web
+
+from .logger import Session
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = T.Tuple[T.Tuple[str, str], ...]
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: T.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # 最后一项为 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # 以桶上界近似分位数
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+NULL_TIMER = _NullTimer() # 关闭指标时共享的空计时器
+
+class Metrics:
+    def __init__(self,
+                 enabled: bool = False,
+                 buckets: T.Sequence[float] = DEFAULT_BUCKETS,
+                 host: str = "127.0.0.1",
+                 port: int = None,
+                 dump_interval: float = None):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.host = host
+        self.port = port # 设置后在 /metrics 提供 Prometheus 文本格式
+        self.dump_interval = dump_interval # 设置后定期输出到日志
+
+        self._histograms: T.Dict[T.Tuple[str, Labels], Histogram] = {}
+        self._counters: T.Dict[T.Tuple[str, Labels], float] = {}
+        self._gauges: T.Dict[T.Tuple[str, Labels], float] = {}
+        self._collectors: T.List[T.Callable[[], T.Iterable[T.Tuple[str, T.Dict[str, str], float]]]] = []
+        self._tasks: T.List[asyncio.Task] = []
+        self._runner = None
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        return histogram
+
+    def observe(self, name: str, value: float, **labels):
+        if self.enabled:
+            self.histogram(name, **labels).observe(value)
+
+    def timer(self, name: str, **labels):
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self.histogram(name, **labels))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if self.enabled:
+            key = (name, tuple(sorted(labels.items())))
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        if self.enabled:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def register_collector(self, collector: T.Callable[[], T.Iterable[T.Tuple[str, T.Dict[str, str], float]]]):
+        # collector 在读取指标时才被调用，返回 (name, labels, value) 形式的 gauge
+        self._collectors.append(collector)
+
+    def collect(self) -> T.Dict[T.Tuple[str, Labels], float]:
+        gauges = dict(self._gauges)
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                gauges[(name, tuple(sorted(labels.items())))] = value
+        return gauges
+
+    def snapshot(self) -> T.Dict[str, T.Any]:
+        return {
+            "histograms": {
+                self._format_name(name, labels): {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                    "p99": histogram.quantile(0.99)
+                }
+                for (name, labels), histogram in self._histograms.items()
+            },
+            "counters": {self._format_name(*key): value for key, value in self._counters.items()},
+            "gauges": {self._format_name(*key): value for key, value in self.collect().items()}
+        }
+
+    def render(self) -> str:
+        lines = []
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self._format_name(name + '_bucket', labels + (('le', le),))} {cumulative}")
+            lines.append(f"{self._format_name(name + '_sum', labels)} {histogram.sum}")
+            lines.append(f"{self._format_name(name + '_count', labels)} {histogram.count}")
+        for (name, labels), value in sorted(self._counters.items()):
+            lines.append(f"{self._format_name(name, labels)} {value}")
+        for (name, labels), value in sorted(self.collect().items()):
+            lines.append(f"{self._format_name(name, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _format_name(name: str, labels: Labels) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    async def start(self):
+        if not self.enabled:
+            return
+        if self.port is not None:
+            async def handle(_):
+                return web.Response(text=self.render(), content_type="text/plain")
+
+            app = web.Application()
+            app.router.add_get("/metrics", handle)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            Session.info(f"metrics available at http://{self.host}:{self.port}/metrics")
+        if self.dump_interval:
+            self._tasks.append(asyncio.get_running_loop().create_task(self._dump()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _dump(self):
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            for line in self.render().splitlines():
+                if "_bucket{" not in line:
+                    Session.info(line)
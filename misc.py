@@ -41,4 +41,22 @@ def argument_signature(callable_target) -> T.List[Parameter]:
             default=param.default if param.default != inspect._empty else None
         )
         for name, param in dict(inspect.signature(callable_target).parameters).items()
-    ]
\ No newline at end of file
+    ]
+
+def _read_file(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+async def read_image(image) -> T.Union[bytes, bytearray, memoryview]:
+    if isinstance(image, (bytes, bytearray, memoryview)): # 直接使用，不复制
+        return image
+    if isinstance(image, (str, os.PathLike)): # 文件读取放到线程池，避免阻塞事件循环
+        return await asyncio.get_running_loop().run_in_executor(None, _read_file, image)
+    if hasattr(image, "__aiter__"):
+        return b"".join([chunk async for chunk in image])
+    if hasattr(image, "read"):
+        data = image.read()
+        if inspect.isawaitable(data):
+            data = await data
+        return data
+    raise TypeError(f"unsupported image source: {type(image).__name__}")
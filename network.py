@@ -2,44 +2,100 @@ import json
 import mimetypes
 import typing as T
 from pathlib import Path
-from .logger import Network
+from urllib.parse import urlsplit
+from .logger import Network, is_debug_enabled
+from .metrics import Metrics, NULL_TIMER
 
 import aiohttp
 
+try: # 可选依赖，安装后直接从 bytes 解码
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 class fetch:
-    @staticmethod
-    async def http_post(url, data_map, **_):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data_map, **_) as response:
-                data = await response.text(encoding="utf-8")
-                Network.debug(f"requested url={url}, by data_map={data_map}, and status={response.status}, data={data}")
-                response.raise_for_status()
+    def __init__(self,
+                 limit: int = 100,
+                 limit_per_host: int = 20,
+                 keepalive_timeout: float = 30,
+                 timeout: float = 15,
+                 connect_timeout: float = 5,
+                 loads: T.Callable[[bytes], T.Any] = None,
+                 metrics: Metrics = None,
+                 recorder=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.loads = loads or json_loads
+        self.metrics = metrics
+        self.recorder = recorder # 设置后录制原始响应，见 replay.Recorder
+        self._session: T.Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # 延迟到事件循环中创建，连接池在所有请求之间复用
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    keepalive_timeout=self.keepalive_timeout
+                ),
+                timeout=self.timeout,
+                cookie_jar=aiohttp.DummyCookieJar() # cookies 由每个请求自行携带
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def timer(self, url):
+        if self.metrics is None or not self.metrics.enabled:
+            return NULL_TIMER
+        return self.metrics.timer("bilichat_request_seconds", endpoint=urlsplit(url).path)
+
+    def decode(self, url, payload, data: bytes):
         try:
-            return json.loads(data)
-        except json.decoder.JSONDecodeError:
-            Network.error(f"requested {url} with {data_map}, responsed {data}, decode failed...")
-
-    @staticmethod
-    async def http_get(url, params=None, **_): 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, **_) as response:
+            result = self.loads(data)
+        except ValueError:
+            Network.error(f"requested {url} with {payload}, responsed {data.decode('utf-8', 'replace')}, decode failed...")
+            return None
+        if self.recorder is not None: # 只录制能解析的响应，回放时逐行读取不会失败
+            self.recorder.record(url, payload, data)
+        return result
+
+    async def http_post(self, url, data_map, **_):
+        with self.timer(url):
+            async with self.session.post(url, data=data_map, **_) as response:
+                data = await response.read()
+        if is_debug_enabled(): # 仅在 DEBUG 时格式化响应体
+            Network.debug(f"requested url={url}, by data_map={data_map}, and status={response.status}, data={data.decode('utf-8', 'replace')}")
+        response.raise_for_status()
+        return self.decode(url, data_map, data)
+
+    async def http_get(self, url, params=None, **_):
+        with self.timer(url):
+            async with self.session.get(url, params=params, **_) as response:
                 response.raise_for_status()
-                data = await response.text(encoding="utf-8")
-                Network.debug(f"requested url={url}, by params={params}, and status={response.status}, data={data}")
-        try:
-            return json.loads(data)
-        except json.decoder.JSONDecodeError:
-            Network.error(f"requested {url} with {params}, responsed {data}, decode failed...")
+                data = await response.read()
+        if is_debug_enabled():
+            Network.debug(f"requested url={url}, by params={params}, and status={response.status}, data={data.decode('utf-8', 'replace')}")
+        return self.decode(url, params, data)
 
-    @staticmethod
-    async def upload(url, filedata: bytes, addon_dict: dict, **_):
+    async def upload(self, url, filedata: bytes, addon_dict: dict, **_):
         upload_data = aiohttp.FormData()
         upload_data.add_field("file_up", filedata)
         for item in addon_dict.items():
             upload_data.add_fields(item)
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=upload_data, **_) as response:
+        with self.timer(url):
+            async with self.session.post(url, data=upload_data, **_) as response:
                 response.raise_for_status()
-                Network.debug(f"requested url={url}, and status={response.status}, addon_dict={addon_dict}")
-                return await response.json()
\ No newline at end of file
+                data = await response.read()
+        if is_debug_enabled():
+            Network.debug(f"requested url={url}, and status={response.status}, addon_dict={addon_dict}")
+        return self.decode(url, addon_dict, data)
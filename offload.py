@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import multiprocessing
+import typing as T
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+OFFLOAD_NONE = None
+OFFLOAD_THREAD = "thread" # 线程池，适合释放 GIL 的计算或阻塞 IO
+OFFLOAD_PROCESS = "process" # 进程池，参数与结果经 pickle 传递
+
+class OffloadPool:
+    def __init__(self,
+                 processes: int = None,
+                 threads: int = None,
+                 max_pending: int = 256,
+                 mp_context: str = None):
+        self.processes = processes # None 时为 CPU 核数
+        self.threads = threads
+        self.max_pending = max_pending # 同时提交到池中的任务上限，满时调用方等待
+        self.mp_context = mp_context # "spawn" / "forkserver" / "fork"
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+        self.waiting = 0
+
+        self._executors: T.Dict[str, Executor] = {}
+        self._slots: T.Optional[asyncio.Semaphore] = None
+
+    def executor(self, mode: str) -> Executor:
+        # 首次使用时才创建，未使用 offload 的机器人不会启动额外的进程
+        executor = self._executors.get(mode)
+        if executor is None:
+            if mode == OFFLOAD_PROCESS:
+                executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context(self.mp_context) if self.mp_context else None
+                )
+            elif mode == OFFLOAD_THREAD:
+                executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="bilichat-offload")
+            else:
+                raise ValueError(f"unknown offload mode: {mode}")
+            self._executors[mode] = executor
+        return executor
+
+    async def run(self, func: T.Callable, *args, mode: str = OFFLOAD_PROCESS, **kwargs):
+        executor = self.executor(mode)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        self.submitted += 1
+        self.waiting += 1
+        async with self._slots:
+            self.waiting -= 1
+            self.running += 1
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    executor, functools.partial(func, *args, **kwargs)
+                )
+                self.completed += 1
+                return result
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.running -= 1
+
+    async def close(self):
+        executors, self._executors = list(self._executors.values()), {}
+        loop = asyncio.get_running_loop()
+        for executor in executors:
+            await loop.run_in_executor(None, functools.partial(executor.shutdown, wait=True, cancel_futures=True))
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed
+        }
@@ -1,14 +1,16 @@
 import typing as T
 import json
 import time
-import io
 
 from .entities import User, Group
 from .event.models import BotMessage
-from .network import fetch
+from .sender import PRIORITY_HIGH, PRIORITY_NORMAL
+from .misc import read_image
+from .logger import Network
 
 class BiliChat_Protocol:
-    async def _sendMessage(self, receiver_id: int, receiver_type: int, message_type: int, content, at_uid: int = 0):
+    async def _sendMessage(self, receiver_id: int, receiver_type: int, message_type: int, content, at_uid: int = 0,
+                           priority: int = PRIORITY_NORMAL):
         if isinstance(content, dict):
             content = json.dumps(content, ensure_ascii=False)
         data = {
@@ -30,85 +32,137 @@ class BiliChat_Protocol:
         if at_uid != 0:
             data['msg[at_uids][0]'] = at_uid
         
-        result = await fetch.http_post(f"{self.baseurl}/web_im/v1/web_im/send_msg", data_map=data, cookies=self.cookies)
+        # 经由发送队列统一限速、排序与重试
+        result = await self.send_dispatcher.submit(
+            lambda: self.network.http_post(f"{self.baseurl}/web_im/v1/web_im/send_msg", data_map=data, cookies=self.cookies),
+            receiver_id,
+            priority
+        )
+        self.poll_scheduler.wake() # 刚回复过的会话很可能马上有新消息
         return result["data"]
 
-    async def sendPrivateMessage(self, receiver_id: int, message: str, at_uid: int = 0):
+    async def sendPrivateMessage(self, receiver_id: int, message: str, at_uid: int = 0, priority: int = PRIORITY_NORMAL):
         return BotMessage.parse_obj(
             await self._sendMessage(receiver_id, 1, 1, {
                 'content': message
-            }, at_uid)
+            }, at_uid, priority)
         )
 
-    async def sendGroupMessage(self, receiver_id: int, message: str, at_uid: int = 0):
+    async def sendGroupMessage(self, receiver_id: int, message: str, at_uid: int = 0, priority: int = PRIORITY_NORMAL):
         return BotMessage.parse_obj(
             await self._sendMessage(receiver_id, 2, 1, {
                 'content': message
-            }, at_uid)
+            }, at_uid, priority)
         )
 
-    async def uploadPrivateImage(self, receiver_id: int, path: str, at_uid: int = 0):
-        image = open(path, "rb").read()
-        result = await fetch.upload("https://api.bilibili.com/x/dynamic/feed/draw/upload_bfs", image, {
+    async def _uploadImage(self, path) -> dict:
+        image = await read_image(path)
+        upload = lambda: self.network.upload(self.upload_url, image, {
             "biz": "im",
             "csrf": self.cookies['bili_jct'],
             "build": "0",
             "mobi_app": "web"
         }, cookies=self.cookies)
-        return BotMessage.parse_obj(
-            await self._sendMessage(receiver_id, 1, 2, {
+
+        async def upload_image():
+            result = await upload()
+            return {
                 "url": result["data"]["image_url"],
                 "height": result["data"]["image_height"],
                 "width": result["data"]["image_width"],
+                "size": int(len(image) / 1e3)
+            }
+        # 相同内容的图片只上传一次
+        return await self.image_cache.get_or_upload(self.image_cache.digest(image), upload_image)
+
+    async def uploadPrivateImage(self, receiver_id: int, path, at_uid: int = 0, priority: int = PRIORITY_NORMAL):
+        image = await self._uploadImage(path)
+        return BotMessage.parse_obj(
+            await self._sendMessage(receiver_id, 1, 2, {
+                "url": image["url"],
+                "height": image["height"],
+                "width": image["width"],
                 "imageType": "jpeg",
                 "original": 1,
-                "size": int(len(io.BytesIO(image).read()) / 1e3)
-            }, at_uid)
+                "size": image["size"]
+            }, at_uid, priority)
         )
 
-    async def uploadGroupImage(self, receiver_id: int, path: str, at_uid: int = 0):
-        image = open(path, "rb").read()
-        result = await fetch.upload("https://api.bilibili.com/x/dynamic/feed/draw/upload_bfs", image, {
-            "biz": "im",
-            "csrf": self.cookies['bili_jct'],
-            "build": "0",
-            "mobi_app": "web"
-        }, cookies=self.cookies)
+    async def uploadGroupImage(self, receiver_id: int, path, at_uid: int = 0, priority: int = PRIORITY_NORMAL):
+        image = await self._uploadImage(path)
         return BotMessage.parse_obj(
             await self._sendMessage(receiver_id, 2, 2, {
-                "url": result["data"]["image_url"],
-                "height": result["data"]["image_height"],
-                "width": result["data"]["image_width"],
+                "url": image["url"],
+                "height": image["height"],
+                "width": image["width"],
                 "imageType": "jpeg",
                 "original": 1,
-                "size": int(len(io.BytesIO(image).read()) / 1e3)
-            }, at_uid)
+                "size": image["size"]
+            }, at_uid, priority)
         )
     
-    async def recallPrivateMessage(self, receiver_id: int, message_key: int, at_uid: int = 0):
+    async def recallPrivateMessage(self, receiver_id: int, message_key: int, at_uid: int = 0, priority: int = PRIORITY_HIGH):
         return BotMessage.parse_obj(
-            await self._sendMessage(receiver_id, 1, 5, message_key, at_uid)
+            await self._sendMessage(receiver_id, 1, 5, message_key, at_uid, priority)
         )
     
-    async def recallGroupMessage(self, receiver_id: int, message_key: int, at_uid: int = 0):
+    async def recallGroupMessage(self, receiver_id: int, message_key: int, at_uid: int = 0, priority: int = PRIORITY_HIGH):
         return BotMessage.parse_obj(
-            await self._sendMessage(receiver_id, 2, 5, message_key, at_uid)
+            await self._sendMessage(receiver_id, 2, 5, message_key, at_uid, priority)
         )
 
+    async def getUser(self, user_id: int) -> User:
+        return await self.user_list.fetch(int(user_id))
+
+    async def getGroup(self, group_id: int) -> Group:
+        return await self.group_list.fetch(int(group_id))
+
+    async def getSessions(self, end_ts: int = None) -> dict:
+        params = {
+            "session_type": 4, # 1: 私聊, 2: 通知, 3: 应援团, 4: 全部
+            "group_fold": 1,
+            "unfollow_fold": 0,
+            "sort_rule": 2,
+            "build": 0,
+            "mobi_app": "web"
+        }
+        if end_ts is not None: # 翻页，获取更早的会话
+            params["end_ts"] = end_ts
+        result = await self.network.http_get(f"{self.baseurl}/session_svr/v1/session_svr/get_sessions", params=params, cookies=self.cookies)
+        return result["data"]
+
+    async def updateAck(self, talker_id: int, session_type: int, ack_seqno: int):
+        return await self.network.http_post(f"{self.baseurl}/svr_sync/v1/svr_sync/update_ack", None, params={
+            "talker_id": talker_id,
+            "session_type": session_type,
+            "ack_seqno": ack_seqno,
+            "build": 0,
+            "mobi_app": "web",
+            'csrf_token': self.cookies['bili_jct'],
+            'csrf': self.cookies['bili_jct']
+        }, cookies=self.cookies)
+
     async def getUserDetail(self, user_id: int):
-        result = await fetch.http_get(f"{self.baseurl}/account/v1/user/infos", params={
-            "uids": user_id,
+        return await self.user_loader.load(int(user_id))
+
+    async def getUserDetails(self, user_ids: T.List[int]) -> T.Dict[int, User]:
+        result = await self.network.http_get(f"{self.baseurl}/account/v1/user/infos", params={
+            "uids": ",".join(str(user_id) for user_id in user_ids),
             "build": 0,
             "mobi_app": "web"
         }, cookies=self.cookies)
-        if result['code'] != 0:
-            print(result)
-        return User.parse_obj(result["data"][0])
+        if result['code'] != 0: # 例如 -412 被拦截；抛出使本批次的请求失败，而不是把所有 uid 缓存为 None
+            Network.error(f"getting user details returned code {result['code']}: {result.get('message')}")
+            raise RuntimeError(f"user/infos returned code {result['code']}")
+        # 成功响应中缺少的 uid（如已注销的账号）由 BatchLoader 解析为 None
+        users = [User.parse_obj(user) for user in result["data"] or []]
+        return {user.uid: user for user in users}
 
     async def getGroupDetail(self, group_id: int):
-        result = await fetch.http_get(f"{self.baseurl}/link_group/v1/group/detail", params={
+        result = await self.network.http_get(f"{self.baseurl}/link_group/v1/group/detail", params={
             "group_id": group_id,
         }, cookies=self.cookies)
         if result['code'] != 0:
-            print(result)
+            Network.error(f"getting group {group_id} returned code {result['code']}: {result.get('message')}")
+            raise RuntimeError(f"group/detail returned code {result['code']}")
         return Group.parse_obj(result["data"])
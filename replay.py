@@ -0,0 +1,163 @@
+import asyncio
+import gzip
+import json
+import queue
+import threading
+import time
+import typing as T
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from .entities import User, Group
+from .logger import Session
+from .network import json_loads
+
+NEW_SESSIONS = "/session_svr/v1/session_svr/new_sessions"
+FETCH_SESSION_MSGS = "/svr_sync/v1/svr_sync/fetch_session_msgs"
+USER_INFOS = "/account/v1/user/infos"
+GROUP_DETAIL = "/link_group/v1/group/detail"
+RECORDED_ENDPOINTS = (NEW_SESSIONS, FETCH_SESSION_MSGS, USER_INFOS, GROUP_DETAIL)
+
+def open_records(path: Path, mode: str):
+    # 以 .gz 结尾时使用 gzip，追加写入会产生多个 member，读取时可透明拼接
+    if path.suffix == ".gz":
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+class Recorder:
+    # record 在事件循环中只入队，序列化、压缩与写文件都在后台线程完成
+    def __init__(self, path: T.Union[str, Path], endpoints: T.Sequence[str] = RECORDED_ENDPOINTS):
+        self.path = Path(path)
+        self.endpoints = tuple(endpoints)
+        self.records = 0
+        self._file = None
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: T.Optional[threading.Thread] = None
+
+    def record(self, url: str, params, data: bytes):
+        endpoint = urlsplit(url).path
+        if not endpoint.endswith(self.endpoints):
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_forever, name="bilichat-recorder", daemon=True)
+            self._thread.start()
+        self._queue.put((time.time(), endpoint, params, data))
+        self.records += 1
+
+    def _write_forever(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except OSError as e:
+                Session.warning(f"writing records to {self.path} failed: {e.__class__.__name__}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def write(self, t: float, endpoint: str, params, data: bytes):
+        if self._file is None:
+            self._file = open_records(self.path, "ab")
+        # 响应体原样写入，不重新序列化；JSON 字符串内的换行均已转义，其余换行只是空白
+        self._file.write(b'{"t":%.6f,"endpoint":%s,"params":%s,"data":%s}\n' % (
+            t,
+            json.dumps(endpoint).encode(),
+            json.dumps(params or {}, separators=(",", ":")).encode(),
+            data.replace(b"\n", b" ")
+        ))
+
+    def flush(self):
+        # 阻塞直到已入队的记录全部写出
+        if self._thread is not None:
+            self._queue.join()
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def read_records(path: T.Union[str, Path]) -> T.Iterator[dict]:
+    with open_records(Path(path), "rb") as records:
+        for line in records:
+            if line.strip():
+                yield json_loads(line)
+
+def load_entities(path: T.Union[str, Path]) -> T.Tuple[T.Dict[int, User], T.Dict[int, Group]]:
+    users, groups = {}, {}
+    for record in read_records(path):
+        data = record["data"].get("data") if isinstance(record["data"], dict) else None
+        if not data:
+            continue
+        if record["endpoint"].endswith(USER_INFOS):
+            for user in data:
+                user = User.parse_obj(user)
+                users[user.uid] = user
+        elif record["endpoint"].endswith(GROUP_DETAIL):
+            group = Group.parse_obj(data)
+            groups[group.group_id] = group
+    return users, groups
+
+async def replay(bot, path: T.Union[str, Path], speed: float = None) -> T.Dict[str, T.Any]:
+    # 将录制的消息按原有的解析与分发路径投递到 bot.queue，speed 为 None 时尽快回放，1.0 为原始节奏
+    loop = asyncio.get_running_loop()
+    users, groups = await loop.run_in_executor(None, load_entities, path)
+    for uid, user in users.items():
+        bot.user_list.set(uid, user)
+    for group_id, group in groups.items():
+        bot.group_list.set(group_id, group)
+    async def offline(key): # 录制中没有的实体不访问网络
+        return None
+    bot.user_list.loader = offline
+    bot.group_list.loader = offline
+
+    if not bot._tasks:
+        await bot.start(poll=False)
+    polls = messages = duplicates = 0
+    first_record = None
+    started = time.perf_counter()
+    for record in await loop.run_in_executor(None, list, read_records(path)):
+        if speed:
+            if first_record is None:
+                first_record = record["t"]
+            delay = (record["t"] - first_record) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        endpoint = record["endpoint"]
+        if endpoint.endswith(NEW_SESSIONS):
+            polls += 1
+        elif endpoint.endswith(FETCH_SESSION_MSGS):
+            data = record["data"].get("data") or {}
+            parsed = bot.parse_messages(data.get("messages") or [])
+            await bot.prefetch_entities(parsed)
+            enqueued = await bot.enqueue_messages(int(record["params"]["talker_id"]), parsed)
+            messages += enqueued
+            duplicates += len(parsed) - enqueued
+    enqueued = time.perf_counter()
+    while bot.queue.qsize(): # 等待 event_runner 取完队列
+        await asyncio.sleep(0.01)
+    await bot.handler_pool.join()
+    elapsed = time.perf_counter() - started
+
+    stats = {
+        "polls": polls,
+        "messages": messages,
+        "duplicates": duplicates,
+        "users": len(users),
+        "groups": len(groups),
+        "enqueue_seconds": enqueued - started,
+        "elapsed": elapsed,
+        "throughput": messages / elapsed if elapsed else 0.0,
+        "handlers": bot.handler_pool.stats()
+    }
+    Session.info(
+        f"replayed {messages} messages ({duplicates} duplicates skipped) from {polls} polls in {elapsed:.2f}s "
+        f"({stats['throughput']:.1f} msg/s, {stats['handlers']['completed']} handler calls, {stats['handlers']['failed']} failed)"
+    )
+    return stats
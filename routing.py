@@ -0,0 +1,119 @@
+import re
+import typing as T
+
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=") # 合并后组号会变化，含反向引用的表达式单独匹配
+
+def _as_set(value) -> T.Optional[T.FrozenSet[int]]:
+    if value is None:
+        return None
+    if isinstance(value, (int, str)):
+        value = (value,)
+    return frozenset(int(i) for i in value)
+
+class Route:
+    __slots__ = ("commands", "patterns", "receiver_type", "group_ids", "sender_ids")
+
+    def __init__(self,
+                 command: T.Union[str, T.Iterable[str]] = None,
+                 regex: T.Union[str, T.Pattern, T.Iterable[T.Union[str, T.Pattern]]] = None,
+                 receiver_type: int = None,
+                 group_id: T.Union[int, T.Iterable[int]] = None,
+                 sender_id: T.Union[int, T.Iterable[int]] = None):
+        if isinstance(command, str):
+            command = (command,)
+        if isinstance(regex, (str, re.Pattern)):
+            regex = (regex,)
+        self.commands = tuple(command or ())
+        self.patterns = tuple(re.compile(pattern) for pattern in regex or ())
+        self.receiver_type = receiver_type # 1: 私聊, 2: 应援团
+        self.group_ids = _as_set(group_id)
+        self.sender_ids = _as_set(sender_id)
+
+    @property
+    def textual(self) -> bool:
+        return bool(self.commands or self.patterns)
+
+    def accepts(self, body) -> bool:
+        if self.receiver_type is not None and body.receiver_type != self.receiver_type:
+            return False
+        if self.group_ids is not None and (body.receiver_type != 2 or body.receiver_id not in self.group_ids):
+            return False
+        if self.sender_ids is not None and body.sender_uid not in self.sender_ids:
+            return False
+        return True
+
+class Router:
+    # 同一事件名下所有处理器共享的索引：命令前缀树 + 合并后的正则，只返回可能匹配的处理器
+    def __init__(self, handlers: T.Sequence):
+        self.handlers = tuple(handlers)
+        self.routed = any(handler.route is not None for handler in self.handlers)
+        self._always: T.List[int] = [] # 不限定文本的处理器
+        self._trie: dict = {}
+        self._combined: T.List[T.Tuple[T.Pattern, T.List[T.Tuple[str, int]]]] = []
+        self._fallback: T.List[T.Tuple[T.Pattern, int]] = []
+
+        by_flags: T.Dict[int, T.List[T.Tuple[T.Pattern, int]]] = {}
+        for index, handler in enumerate(self.handlers):
+            route = handler.route
+            if route is None or not route.textual:
+                self._always.append(index)
+                continue
+            for command in route.commands:
+                node = self._trie
+                for char in command:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(index)
+            for pattern in route.patterns:
+                if _BACKREFERENCE.search(pattern.pattern):
+                    self._fallback.append((pattern, index))
+                else:
+                    by_flags.setdefault(pattern.flags, []).append((pattern, index))
+        for flags, patterns in by_flags.items():
+            self.combine(flags, patterns)
+
+    def combine(self, flags: int, patterns: T.List[T.Tuple[T.Pattern, int]]):
+        # 每个表达式包在可选的前瞻中，一次 match 即可得到所有命中的表达式
+        groups = [(f"_route{i}", index) for i, (_, index) in enumerate(patterns)]
+        source = "".join(
+            f"(?:(?=[\\s\\S]*?(?P<{name}>{pattern.pattern}))|)"
+            for (name, _), (pattern, _) in zip(groups, patterns)
+        )
+        try:
+            self._combined.append((re.compile(source, flags), groups))
+        except re.error: # 例如重复的命名组，退回逐个匹配
+            self._fallback.extend(patterns)
+
+    @staticmethod
+    def text_of(body) -> T.Optional[str]:
+        if getattr(body, "msg_type", None) != 1:
+            return None
+        content = body.content
+        return content.get("content") if isinstance(content, dict) else None
+
+    def match(self, body) -> tuple:
+        if not self.routed:
+            return self.handlers
+        matched = set(self._always)
+        text = self.text_of(body) if len(matched) < len(self.handlers) else None
+        if text is not None:
+            node, length = self._trie, len(text)
+            for position in range(length + 1):
+                # 命令需完整匹配，其后为结尾或空白
+                if None in node and (position == length or text[position].isspace()):
+                    matched.update(node[None])
+                if position == length:
+                    break
+                node = node.get(text[position])
+                if node is None:
+                    break
+            for pattern, groups in self._combined:
+                result = pattern.match(text)
+                matched.update(index for name, index in groups if result.start(name) != -1)
+            for pattern, index in self._fallback:
+                if index not in matched and pattern.search(text):
+                    matched.add(index)
+        handlers = self.handlers
+        return tuple(
+            handlers[index] for index in sorted(matched)
+            if handlers[index].route is None or handlers[index].route.accepts(body)
+        )
@@ -0,0 +1,72 @@
+import asyncio
+import typing as T
+
+class PollScheduler:
+    def __init__(self,
+                 min_interval: float = 0.5,
+                 max_interval: float = 10,
+                 backoff_factor: float = 1.5,
+                 idle_threshold: int = 1,
+                 curve: T.Callable[[int], float] = None,
+                 offset: float = 0.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.idle_threshold = idle_threshold # 连续空轮询多少次后开始退避
+        self.curve = curve # 自定义退避曲线: 连续空轮询次数 -> 间隔秒数
+        self.offset = offset # 首次轮询前的延迟，用于错开多个账号
+
+        self.interval = min_interval
+        self.idle_streak = 0
+        self.polls = 0
+        self.active_polls = 0
+        self.idle_polls = 0
+        self._wakeup: T.Optional[asyncio.Event] = None
+
+    def record(self, active: bool):
+        self.polls += 1
+        if active:
+            self.active_polls += 1
+            self.idle_streak = 0
+        else:
+            self.idle_polls += 1
+            self.idle_streak += 1
+        self.interval = self.next_interval()
+
+    def next_interval(self) -> float:
+        if self.curve is not None:
+            interval = self.curve(self.idle_streak)
+        elif self.idle_streak < self.idle_threshold:
+            interval = self.min_interval
+        else:
+            interval = self.min_interval * self.backoff_factor ** (self.idle_streak - self.idle_threshold + 1)
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def wake(self):
+        # 有外部活动（例如机器人发出回复）时立即回到最短间隔
+        self.idle_streak = 0
+        self.interval = self.min_interval
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stagger(self):
+        if self.offset > 0:
+            await asyncio.sleep(self.offset)
+
+    async def wait(self):
+        self._wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), self.interval)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._wakeup = None
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "interval": self.interval,
+            "idle_streak": self.idle_streak,
+            "polls": self.polls,
+            "active_polls": self.active_polls,
+            "idle_polls": self.idle_polls
+        }
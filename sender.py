@@ -0,0 +1,186 @@
+import asyncio
+import itertools
+import time
+import typing as T
+
+import aiohttp
+
+from .logger import Protocol
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 10
+
+# 只有连接尚未建立时可以安全重发；超时或已发出的请求可能已被服务端处理，重发会导致重复消息
+RETRYABLE_ERRORS = (aiohttp.ClientConnectorError,)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # 取得令牌返回 0，否则返回还需等待的秒数（不消耗令牌）
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            delay = self.reserve()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+class _SendJob:
+    __slots__ = ("factory", "receiver_id", "priority", "future", "attempts", "submitted_at")
+
+    def __init__(self, factory, receiver_id, priority, future):
+        self.factory = factory
+        self.receiver_id = receiver_id
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+        self.submitted_at = time.monotonic()
+
+class SendDispatcher:
+    def __init__(self,
+                 global_rate: float = 5,
+                 global_burst: float = 10,
+                 receiver_rate: float = 1,
+                 receiver_burst: float = 3,
+                 max_retries: int = 3,
+                 retry_backoff: float = 1.0,
+                 throttle_codes: T.Iterable[int] = (-412, -509)):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.receiver_rate = receiver_rate
+        self.receiver_burst = receiver_burst
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.throttle_codes = set(throttle_codes)
+
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        self._buckets: T.Dict[int, TokenBucket] = {}
+        self._queue: T.Optional[asyncio.PriorityQueue] = None
+        self._worker: T.Optional[asyncio.Task] = None
+        self._counter = itertools.count()
+        self._inflight: T.Set[asyncio.Task] = set()
+
+    async def submit(self,
+                     factory: T.Callable[[], T.Awaitable[dict]],
+                     receiver_id: int,
+                     priority: int = PRIORITY_NORMAL) -> dict:
+        loop = asyncio.get_running_loop()
+        if self._worker is None:
+            self._queue = asyncio.PriorityQueue()
+            self._worker = loop.create_task(self._dispatch())
+        job = _SendJob(factory, receiver_id, priority, loop.create_future())
+        self.depth += 1
+        self._put(job)
+        return await job.future
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, *self._inflight, return_exceptions=True)
+            self._worker = None
+        while self._queue is not None and not self._queue.empty():
+            _, _, job = self._queue.get_nowait()
+            job.future.cancel()
+
+    def _put(self, job: _SendJob):
+        self._queue.put_nowait((job.priority, next(self._counter), job))
+
+    def _bucket(self, receiver_id: int) -> TokenBucket:
+        bucket = self._buckets.get(receiver_id)
+        if bucket is None:
+            if len(self._buckets) >= 1024: # 丢弃已回满的空闲令牌桶
+                self._buckets = {k: v for k, v in self._buckets.items() if not v.full}
+            bucket = self._buckets[receiver_id] = TokenBucket(self.receiver_rate, self.receiver_burst)
+        return bucket
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            if job.future.done(): # 调用方已取消
+                self.depth -= 1
+                continue
+            delay = self._bucket(job.receiver_id).reserve()
+            if delay: # 该接收者超出限速，稍后重新排队，不阻塞其他接收者
+                loop.call_later(delay, self._put, job)
+                continue
+            await self.global_bucket.acquire()
+            task = loop.create_task(self._send(job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, job: _SendJob):
+        job.attempts += 1
+        try:
+            result = await job.factory()
+        except RETRYABLE_ERRORS as e:
+            return self._retry_or_fail(job, e)
+        except Exception as e: # 超时、ClientResponseError 等直接交给调用方
+            return self._fail(job, e)
+        if isinstance(result, dict) and result.get("code") in self.throttle_codes:
+            self.throttled += 1
+            return self._retry_or_fail(job, RuntimeError(f"send throttled with code {result.get('code')}"))
+        self._finish(job)
+        if not job.future.done():
+            job.future.set_result(result)
+        self.sent += 1
+
+    def _retry_or_fail(self, job: _SendJob, error: Exception):
+        if job.attempts <= self.max_retries and not job.future.done():
+            self.retries += 1
+            delay = self.retry_backoff * 2 ** (job.attempts - 1)
+            Protocol.warning(f"sending to {job.receiver_id} failed ({error}), retrying in {delay}s")
+            asyncio.get_running_loop().call_later(delay, self._put, job)
+            return
+        self._fail(job, error)
+
+    def _fail(self, job: _SendJob, error: Exception):
+        self._finish(job)
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def _finish(self, job: _SendJob):
+        self.depth -= 1
+        latency = time.monotonic() - job.submitted_at
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        finished = self.sent + self.failed
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "latency_avg": self.latency_total / finished if finished else 0.0,
+            "latency_max": self.latency_max
+        }
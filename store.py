@@ -0,0 +1,62 @@
+import time
+import typing as T
+from collections import OrderedDict, deque
+
+class MessageStore:
+    def __init__(self,
+                 capacity: int = 10000,
+                 max_age: float = None,
+                 per_talker: int = 200):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.per_talker = per_talker
+        self.evictions = 0
+
+        self._messages: "OrderedDict[int, T.Tuple[T.Any, T.Any, float]]" = OrderedDict() # msg_key -> (message, talker_id, stored_at)
+        self._talkers: T.Dict[T.Any, T.Deque[int]] = {} # talker_id -> 最近的 msg_key
+
+    def __contains__(self, msg_key):
+        return msg_key in self._messages
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return (message for message, _, _ in list(self._messages.values()))
+
+    def append(self, message, talker_id=None):
+        if message.msg_key in self._messages:
+            return
+        self._messages[message.msg_key] = (message, talker_id, time.monotonic())
+        if talker_id is not None:
+            keys = self._talkers.get(talker_id)
+            if keys is None:
+                keys = self._talkers[talker_id] = deque(maxlen=self.per_talker)
+            keys.append(message.msg_key)
+        self.evict()
+
+    def get(self, msg_key, default=None):
+        entry = self._messages.get(int(msg_key))
+        return default if entry is None else entry[0]
+
+    def recent(self, talker_id, limit: int = None) -> T.List[T.Any]:
+        keys = list(self._talkers.get(talker_id, ()))
+        if limit is not None:
+            keys = keys[-limit:]
+        return [self._messages[key][0] for key in keys if key in self._messages]
+
+    def evict(self):
+        deadline = time.monotonic() - self.max_age if self.max_age is not None else None
+        while self._messages:
+            msg_key, (_, talker_id, stored_at) = next(iter(self._messages.items()))
+            if len(self._messages) <= self.capacity and (deadline is None or stored_at > deadline):
+                break
+            del self._messages[msg_key]
+            self.evictions += 1
+            # 按插入顺序淘汰，被淘汰的总是该会话索引里最旧的一条
+            keys = self._talkers.get(talker_id)
+            if keys is not None:
+                if keys and keys[0] == msg_key:
+                    keys.popleft()
+                if not keys:
+                    del self._talkers[talker_id]
@@ -0,0 +1,109 @@
+import asyncio
+import typing as T
+from collections import deque
+
+from .logger import Event
+
+ORDERING_NONE = None
+ORDERING_TALKER = "talker" # 同一会话的处理器串行执行
+ORDERING_RECEIVER = "receiver" # 同一 receiver_id 的处理器串行执行
+
+class HandlerPool:
+    def __init__(self,
+                 max_workers: int = 64,
+                 queue_size: int = 1024,
+                 ordering: T.Optional[str] = ORDERING_NONE):
+        if ordering not in (ORDERING_NONE, ORDERING_TALKER, ORDERING_RECEIVER):
+            raise ValueError(f"unknown handler ordering: {ordering}")
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.ordering = ordering
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+        self.pending = 0
+
+        self._queue: T.Optional[asyncio.Queue] = None
+        self._slots: T.Optional[asyncio.Semaphore] = None
+        self._lanes: T.Dict[T.Hashable, T.Deque[T.Callable[[], T.Awaitable]]] = {} # 正在执行的有序通道
+        self._workers: T.List[asyncio.Task] = []
+        self._idle: T.Optional[asyncio.Event] = None # 没有排队和执行中的任务时置位
+
+    def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.queue_size) # 排队中的任务总数上限，满时 submit 等待
+        self._idle = asyncio.Event()
+        self._idle.set()
+        loop = asyncio.get_running_loop()
+        self._workers = [loop.create_task(self._worker()) for _ in range(self.max_workers)]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._lanes.clear()
+
+    async def submit(self, job: T.Callable[[], T.Awaitable], key: T.Hashable = None):
+        if not self._workers:
+            self.start()
+        await self._slots.acquire()
+        self.submitted += 1
+        self.pending += 1
+        self._idle.clear()
+        if key is not None:
+            lane = self._lanes.get(key)
+            if lane is not None: # 该通道正在执行，排在其后
+                lane.append(job)
+                return
+            self._lanes[key] = deque()
+        self._queue.put_nowait((key, job))
+
+    async def join(self):
+        if self._idle is not None:
+            await self._idle.wait()
+
+    async def _worker(self):
+        while True:
+            key, job = await self._queue.get()
+            while job is not None:
+                self._slots.release()
+                self.pending -= 1
+                await self._run(job)
+                job = None
+                if key is not None: # 继续执行同一通道中的下一个任务
+                    lane = self._lanes[key]
+                    if lane:
+                        job = lane.popleft()
+                    else:
+                        del self._lanes[key]
+
+    async def _run(self, job):
+        self.running += 1
+        try:
+            await job()
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            Event.exception(f"handler raised a error: {e.__class__.__name__}: {e}")
+        finally:
+            self.running -= 1
+            if not self.pending and not self.running:
+                self._idle.set()
+
+    def stats(self) -> T.Dict[str, T.Any]:
+        return {
+            "max_workers": self.max_workers,
+            "running": self.running,
+            "pending": self.pending,
+            "lanes": len(self._lanes),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed
+        }